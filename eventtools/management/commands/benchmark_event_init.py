@@ -0,0 +1,61 @@
+import timeit
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
+
+from eventtools.models import occurrence_models
+
+def _time(f, number):
+    """
+    The time f takes, in microseconds per call (the best of three runs of `number` calls).
+    """
+    return min(timeit.Timer(f).repeat(3, number)) / number * 1e6
+
+class Command(BaseCommand):
+    args = '[app_label.EventModel ...]'
+    help = """
+    Times the instantiation of events, with and without a parent to inherit fields from, and the loading of events
+    with a queryset, for each number of the model's fields_to_inherit (0, 1, ... all of them). Times are in
+    microseconds per event. With no arguments, every event model that has occurrences is timed.
+
+    Loading includes the query, so run it against a database with a few events, and compare runs on the same
+    database.
+    """
+    option_list = BaseCommand.option_list + (
+        make_option('--number', type='int', dest='number', default=10000,
+            help='The number of events to instantiate in each run.'),
+    )
+
+    def handle(self, *labels, **options):
+        number = options.get('number')
+        if labels:
+            models = []
+            for label in labels:
+                try:
+                    app_label, model_name = label.split('.')
+                except ValueError:
+                    raise CommandError("Give models as app_label.ModelName, not %r." % label)
+                model = get_model(app_label, model_name)
+                if model is None or not hasattr(model, '_inherited_fields'):
+                    raise CommandError("%s is not an event model." % label)
+                models.append(model)
+        else:
+            models = sorted(set(m.Event() for m in occurrence_models()), key=lambda m: m._meta.object_name)
+
+        for model in models:
+            inherited = model._inherited_fields
+            parent = model()
+            events = model._event_manager.all()
+            loaded = max(len(events), 1)
+            try:
+                for n in range(len(inherited) + 1):
+                    model._inherited_fields = inherited[:n]
+                    without_parent = _time(lambda: model(), number)
+                    with_parent = _time(lambda: model(parent=parent), number)
+                    loading = _time(lambda: list(events.all()), max(number / loaded, 1)) / loaded
+                    self.stdout.write("%s, inheriting %s: %.1f without parent, %.1f with parent, %.1f loading (%s events)\n" % (
+                        model._meta.object_name, ", ".join(name for name, attname in inherited[:n]) or "nothing",
+                        without_parent, with_parent, loading, len(events)))
+            finally:
+                model._inherited_fields = inherited
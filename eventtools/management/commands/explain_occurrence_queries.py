@@ -0,0 +1,131 @@
+import inspect
+from optparse import make_option
+from datetime import date, timedelta
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connections
+from django.db.models.query import QuerySet
+from django.db.models.sql.datastructures import EmptyResultSet
+
+from eventtools.models import OccurrenceQuerySetFN, occurrence_models
+
+# sample arguments for the query functions, by argument name
+SAMPLE_ARGS = {
+    'date': date.today(),
+    'day': date.today(),
+    'd1': date.today(),
+    'd2': date.today() + timedelta(7),
+}
+
+def _explain(connection, sql, params):
+    """
+    Returns the plan of a query as a list of strings, one per line or row.
+    """
+    cursor = connection.cursor()
+    if connection.vendor == 'sqlite':
+        cursor.execute('EXPLAIN QUERY PLAN %s' % sql, params)
+    else:
+        cursor.execute('EXPLAIN %s' % sql, params)
+    if connection.vendor == 'mysql':
+        columns = [c[0] for c in cursor.description]
+        return [" ".join("%s=%s" % (k, v) for k, v in zip(columns, row)) for row in cursor.fetchall()]
+    return [" ".join(unicode(v) for v in row) for row in cursor.fetchall()]
+
+def _sequential_scans(connection, plan):
+    """
+    Returns the lines of a plan that scan a whole table.
+    """
+    if connection.vendor == 'postgresql':
+        return [line for line in plan if 'Seq Scan' in line]
+    if connection.vendor == 'mysql':
+        return [line for line in plan if 'type=ALL' in line.split()]
+    if connection.vendor == 'sqlite':
+        return [line for line in plan if ' SCAN ' in ' %s ' % line and 'INDEX' not in line]
+    if connection.vendor == 'oracle':
+        return [line for line in plan if 'TABLE ACCESS FULL' in line]
+    return []
+
+# the public methods of OccurrenceQuerySetFN that don't make a query of their own
+NOT_QUERIES = ('cached',)
+
+def _query_functions():
+    """
+    The public query functions of OccurrenceQuerySetFN that take only dates, once each: by their own name rather than
+    an alias (eg starts_between, not between).
+    """
+    functions = {}
+    for name, f in inspect.getmembers(OccurrenceQuerySetFN, inspect.ismethod):
+        if name.startswith('_') or name in NOT_QUERIES:
+            continue
+        if f.im_func not in functions or name == f.im_func.__name__:
+            functions[f.im_func] = name
+    for f, name in sorted(functions.items(), key=lambda item: item[1]):
+        args = inspect.getargspec(f)
+        required = args.args[1:len(args.args) - len(args.defaults or ())]
+        if all(arg in SAMPLE_ARGS for arg in required):
+            yield name, [SAMPLE_ARGS[arg] for arg in required]
+
+class Command(NoArgsCommand):
+    help = """
+    Runs EXPLAIN on the query each OccurrenceQuerySetFN function generates, for every occurrence model, and flags the
+    ones whose plan scans a whole table.
+
+    Run it against a database with realistic data: for small tables, the planner rightly prefers sequential scans.
+    Use --event to explain the queries for one event's occurrences, as the event pages run them. Queries that can't be
+    built or explained are reported, and make the command exit with an error.
+    """
+    option_list = NoArgsCommand.option_list + (
+        make_option('--event', type='int', dest='event', default=None,
+            help='Restrict the queries to the occurrences of the event with this id.'),
+        make_option('--fail', action='store_true', dest='fail', default=False,
+            help='Exit with an error if any query scans a whole table.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        event_id = options.get('event')
+
+        flagged = failed = 0
+        for model in occurrence_models():
+            base = model.objects.all()
+            if event_id is not None:
+                base = base.filter(event=event_id)
+            connection = connections[base.db]
+            for name, args in _query_functions():
+                label = "%s.%s" % (model._meta.object_name, name)
+                try:
+                    qs = getattr(base, name)(*args)
+                    if isinstance(qs, tuple): # from_GET
+                        qs = qs[0]
+                    if not isinstance(qs, QuerySet):
+                        continue
+                    try:
+                        sql, params = qs.query.get_compiler(using=qs.db).as_sql()
+                    except EmptyResultSet:
+                        continue
+                    plan = _explain(connection, sql, params)
+                except Exception, e:
+                    failed += 1
+                    if verbosity > 0:
+                        self.stdout.write("%s: FAILED (%s: %s)\n" % (label, type(e).__name__, e))
+                    continue
+                scans = _sequential_scans(connection, plan)
+                if scans:
+                    flagged += 1
+                if scans and verbosity > 0:
+                    self.stdout.write("%s: SEQUENTIAL SCAN\n" % label)
+                    for line in scans:
+                        self.stdout.write("    %s\n" % line)
+                elif verbosity > 0:
+                    self.stdout.write("%s: ok\n" % label)
+                if verbosity > 1:
+                    self.stdout.write("    %s\n" % sql)
+                    for line in plan:
+                        self.stdout.write("    | %s\n" % line)
+
+        if verbosity > 0:
+            self.stdout.write("%s queries scan a whole table, %s failed.\n" % (flagged, failed))
+        if failed:
+            raise CommandError("%s queries couldn't be explained." % failed)
+        if flagged and options.get('fail'):
+            raise CommandError("%s queries scan a whole table." % flagged)
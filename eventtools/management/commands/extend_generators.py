@@ -0,0 +1,55 @@
+from optparse import make_option
+from datetime import datetime, timedelta
+
+from django.core.management.base import NoArgsCommand
+
+from eventtools.conf import settings
+from eventtools.models import generator_models
+
+class Command(NoArgsCommand):
+    help = """
+    Extends endless generators (those with a rule and no repeat_until) up to DEFAULT_GENERATOR_LIMIT from now.
+
+    Each generator is extended a step at a time, and each step is committed along with the generator's
+    `materialized_until` watermark, so an interrupted run resumes where it left off. The generators that are furthest
+    behind are extended first.
+
+    Run this regularly (eg daily from cron).
+    """
+    option_list = NoArgsCommand.option_list + (
+        make_option('--limit', type='int', dest='limit', default=None,
+            help='The maximum number of generators to extend in this run.'),
+        make_option('--step', type='int', dest='step', default=90,
+            help='The number of days to extend a generator by in each transaction.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        limit = options.get('limit')
+        step = timedelta(days=options.get('step'))
+        horizon = datetime.now() + settings.DEFAULT_GENERATOR_LIMIT
+
+        generator_count = occurrence_count = 0
+        for model in generator_models():
+            if limit is not None and generator_count >= limit:
+                break
+            endless = model._default_manager.filter(
+                rule__isnull=False, repeat_until__isnull=True, virtual=False).select_related('rule')
+            remaining = None if limit is None else limit - generator_count
+            # databases disagree on where NULLs sort, so the never-generated generators are fetched first explicitly.
+            behind = list(endless.filter(materialized_until__isnull=True)[:remaining])
+            if remaining is not None:
+                remaining -= len(behind)
+            behind += list(endless.filter(materialized_until__lt=horizon).order_by('materialized_until')[:remaining])
+
+            for generator in behind:
+                while True:
+                    until = min((generator.materialized_until or generator.event_start) + step, horizon)
+                    occurrence_count += generator.generate(until=until)
+                    if until >= horizon:
+                        break
+                generator_count += 1
+
+        if verbosity > 0:
+            self.stdout.write("Extended %s generators to %s, creating %s occurrences.\n" % (
+                generator_count, horizon, occurrence_count))
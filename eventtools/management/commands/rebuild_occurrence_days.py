@@ -0,0 +1,20 @@
+from django.core.management.base import NoArgsCommand
+
+from eventtools.models import occurrence_models
+
+class Command(NoArgsCommand):
+    help = """
+    Rebuilds the day buckets of every occurrence model that has them (see OccurrenceMeta.day_buckets).
+
+    Run this after turning day_buckets on for a model that already has occurrences, or after changing occurrences'
+    start or end with QuerySet.update().
+    """
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        for model in occurrence_models():
+            if model._occurrence_meta.day_model is None:
+                continue
+            count = model.objects.all().update_days()
+            if verbosity > 0:
+                self.stdout.write("%s: wrote %s day buckets.\n" % (model._meta.object_name, count))
@@ -0,0 +1,24 @@
+from django.core.management.base import NoArgsCommand
+
+from eventtools.conf import settings
+from eventtools.models import occurrence_models
+
+class Command(NoArgsCommand):
+    help = """
+    Recalculates the stored occurrence span of every event of the models that have one (see EventMeta.occurrence_span).
+
+    Run this after turning occurrence_span on for a model that already has occurrences, or after changing occurrences
+    with QuerySet.update().
+    """
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        batch_size = settings.GENERATOR_BATCH_SIZE
+        for model in set(m.Event() for m in occurrence_models()):
+            if not model._event_meta.occurrence_span:
+                continue
+            ids = list(model._event_manager.values_list('pk', flat=True))
+            for i in range(0, len(ids), batch_size):
+                model.update_occurrence_spans(ids[i:i+batch_size])
+            if verbosity > 0:
+                self.stdout.write("%s: updated %s events.\n" % (model._meta.object_name, len(ids)))
@@ -0,0 +1,130 @@
+import os
+import time
+import multiprocessing
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connections
+from django.db.models import get_model, Min, Max
+
+from eventtools.models import generator_models
+
+def _close_connections():
+    # forked workers mustn't share the parent's database connections. Django reconnects on the next query.
+    for connection in connections.all():
+        connection.close()
+
+def _regenerate(task):
+    """
+    Runs in a worker process: generates every generator of one model whose split key falls in [low, high).
+    """
+    model_label, key, low, high, full = task
+    model = get_model(*model_label.split('.'))
+    generators = model._default_manager.filter(**{
+        '%s__gte' % key: low,
+        '%s__lt' % key: high,
+    }).select_related('rule')
+
+    started = time.time()
+    generator_count = occurrence_count = 0
+    failures = []
+    for generator in generators.iterator():
+        try:
+            occurrence_count += generator.generate(full=full)
+            generator_count += 1
+        except Exception, e:
+            failures.append((generator.pk, repr(e)))
+    return {
+        'pid': os.getpid(),
+        'model': model_label,
+        'range': (low, high),
+        'generators': generator_count,
+        'occurrences': occurrence_count,
+        'seconds': time.time() - started,
+        'failures': failures,
+    }
+
+class Command(NoArgsCommand):
+    help = """
+    Regenerates the occurrences of every generator, using a pool of worker processes.
+
+    Generators are split into ranges of their event's MPTT tree_id (the default, which keeps every generator of an
+    event in the same process) or of their own id. Use --full after restoring a database, to check every date of every
+    rule again; otherwise each generator is only extended past its materialized_until watermark (which is all that's
+    needed after raising DEFAULT_GENERATOR_LIMIT). With --workers=1, generators are regenerated in this process.
+    """
+    option_list = NoArgsCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=multiprocessing.cpu_count(),
+            help='The number of worker processes.'),
+        make_option('--split', type='choice', dest='split', choices=('tree', 'id'), default='tree',
+            help="Split generators into ranges of their event's 'tree' id (default) or their own 'id'."),
+        make_option('--chunks', type='int', dest='chunks', default=None,
+            help='The number of ranges to split each model into. Defaults to 4 per worker.'),
+        make_option('--full', action='store_true', dest='full', default=False,
+            help='Generate every date of every rule, not just the dates past the watermark.'),
+    )
+
+    def _tasks(self, split, chunks, full):
+        for model in generator_models():
+            if split == 'tree':
+                event_model = model._meta.get_field('event').rel.to
+                key = 'event__%s' % event_model._mptt_meta.tree_id_attr
+            else:
+                key = 'pk'
+            bounds = model._default_manager.aggregate(low=Min(key), high=Max(key))
+            if bounds['low'] is None:
+                continue
+            size = max(1, (bounds['high'] - bounds['low'] + chunks) // chunks)
+            model_label = '%s.%s' % (model._meta.app_label, model._meta.object_name)
+            for low in range(bounds['low'], bounds['high'] + 1, size):
+                yield (model_label, key, low, low + size, full)
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        workers = options.get('workers')
+        if workers < 1:
+            raise CommandError("--workers must be at least 1.")
+        chunks = options.get('chunks') or workers * 4
+
+        tasks = list(self._tasks(options.get('split'), chunks, options.get('full')))
+        started = time.time()
+        totals = {}
+        def tally(result):
+            worker = totals.setdefault(result['pid'], {'generators': 0, 'occurrences': 0, 'seconds': 0, 'failures': []})
+            for k in ('generators', 'occurrences', 'seconds', 'failures'):
+                worker[k] += result[k]
+            if verbosity > 1:
+                self.stdout.write("%(model)s %(range)s: %(generators)s generators, %(occurrences)s occurrences, "
+                    "%(seconds).1fs, %(failed)s failures (worker %(pid)s)\n" % dict(result, failed=len(result['failures'])))
+
+        if workers == 1:
+            # no point forking for one worker: run in this process (and this transaction).
+            for task in tasks:
+                tally(_regenerate(task))
+        else:
+            _close_connections()
+            pool = multiprocessing.Pool(workers, initializer=_close_connections)
+            try:
+                for result in pool.imap_unordered(_regenerate, tasks):
+                    tally(result)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+
+        elapsed = time.time() - started
+        failure_count = 0
+        for pid, worker in sorted(totals.items()):
+            failure_count += len(worker['failures'])
+            if verbosity > 0:
+                self.stdout.write("worker %s: %s generators (%.1f/s), %s occurrences, %s failures\n" % (
+                    pid, worker['generators'], worker['generators'] / max(worker['seconds'], 0.001),
+                    worker['occurrences'], len(worker['failures'])))
+                for pk, error in worker['failures']:
+                    self.stdout.write("    generator %s: %s\n" % (pk, error))
+        if verbosity > 0:
+            generator_count = sum(w['generators'] for w in totals.values())
+            self.stdout.write("Regenerated %s generators in %.1fs (%.1f/s) with %s failures.\n" % (
+                generator_count, elapsed, generator_count / max(elapsed, 0.001), failure_count))
@@ -2,4 +2,6 @@
 from .event import *
 from .occurrence import *
 from .generator import *
-from .rule import *
\ No newline at end of file
+from .rule import *
+from .merged import *
+from .indexes import *
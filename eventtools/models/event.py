@@ -1,107 +1,267 @@
-from django.db import models
+from django.db import models, connections, router, transaction
+from django.db.models import signals
 from django.db.models.base import ModelBase
 from django.db.models.fields import FieldDoesNotExist
-from django.db.models import Count
+from django.db.models import Count, Min, Max
+from django.db.models.sql.where import AND
+from django.db.models.sql.datastructures import EmptyResultSet
 from django.core.urlresolvers import reverse
 
 from mptt.models import MPTTModel, MPTTModelBase
 from mptt.managers import TreeManager
 
-from eventtools.utils.inheritingdefault import ModelInstanceAwareDefault
+from eventtools.utils import datetimeify, dayify, quantized_now
+from eventtools.conf import settings
+
+import threading
+
+class _EdgeOccurrenceWhere(object):
+    """
+    A where clause that keeps the occurrences that no other occurrence of the same event comes before (or after, if
+    `last`) in (start, end, id) order. It follows its table alias when the query is nested, eg by events().
+    """
+    def __init__(self, model, alias, last=False):
+        self.model = model
+        self.alias = alias
+        self.last = last
+
+    def relabel_aliases(self, change_map):
+        self.alias = change_map.get(self.alias, self.alias)
+
+    def as_sql(self, qn=None, connection=None):
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        sql = """NOT EXISTS (SELECT 1 FROM %(table)s edge WHERE edge.%(event)s = %(alias)s.%(event)s AND (
+            edge.%(start)s %(op)s %(alias)s.%(start)s OR (edge.%(start)s = %(alias)s.%(start)s AND (
+            edge.%(end)s %(op)s %(alias)s.%(end)s OR (edge.%(end)s = %(alias)s.%(end)s AND edge.%(pk)s %(op)s %(alias)s.%(pk)s)))))"""
+        return sql % {
+            'table': qn(opts.db_table),
+            'alias': qn(self.alias),
+            'event': qn(opts.get_field('event').column),
+            'start': qn(opts.get_field('start').column),
+            'end': qn(opts.get_field('end').column),
+            'pk': qn(opts.pk.column),
+            'op': '>' if self.last else '<',
+        }, []
+
+class _RelativesWhere(object):
+    """
+    A where clause that keeps the events that have (or, if negated, don't have) a relative in `matches`, a queryset of
+    events, using the MPTT columns. The relations are:
+        children - events whose parent is the event
+        descendants - events inside the event's (lft, rght) range, in the same tree
+        self_and_descendants - the same, including the event itself
+        parent - the event's parent
+        ancestors - events whose (lft, rght) range contains the event's, in the same tree
+    It follows its table alias when the query is nested.
+    """
+    CONDITIONS = {
+        'children': "r.%(parent)s = %(alias)s.%(pk)s",
+        'descendants': "r.%(tree)s = %(alias)s.%(tree)s AND r.%(left)s > %(alias)s.%(left)s AND r.%(left)s < %(alias)s.%(right)s",
+        'self_and_descendants': "r.%(tree)s = %(alias)s.%(tree)s AND r.%(left)s >= %(alias)s.%(left)s AND r.%(left)s <= %(alias)s.%(right)s",
+        'parent': "r.%(pk)s = %(alias)s.%(parent)s",
+        'ancestors': "r.%(tree)s = %(alias)s.%(tree)s AND r.%(left)s < %(alias)s.%(left)s AND r.%(right)s > %(alias)s.%(right)s",
+    }
+
+    def __init__(self, model, alias, relation, matches, negated=False):
+        self.model = model
+        self.alias = alias
+        self.relation = relation
+        self.matches = matches
+        self.negated = negated
+
+    def relabel_aliases(self, change_map):
+        self.alias = change_map.get(self.alias, self.alias)
+
+    def as_sql(self, qn=None, connection=None):
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        mptt_opts = self.model._mptt_meta
+        column = lambda attr: qn(opts.get_field(attr).column)
+        condition = self.CONDITIONS[self.relation] % {
+            'alias': qn(self.alias),
+            'pk': qn(opts.pk.column),
+            'parent': column(mptt_opts.parent_attr),
+            'tree': column(mptt_opts.tree_id_attr),
+            'left': column(mptt_opts.left_attr),
+            'right': column(mptt_opts.right_attr),
+        }
+        try:
+            matches_sql, params = self.matches.order_by().values('pk').query.get_compiler(connection=connection).as_sql()
+        except EmptyResultSet:
+            if self.negated: # nothing matches, so nothing is excluded
+                return '', []
+            raise
+        sql = "%sEXISTS (SELECT 1 FROM %s r WHERE %s AND r.%s IN (%s))" % (
+            'NOT ' if self.negated else '', qn(opts.db_table), condition, qn(opts.pk.column), matches_sql)
+        return sql, params
 
 class EventQuerySet(models.query.QuerySet):
+    # the extra() selects that hold datetimes, as (name, field) pairs. Some backends (eg sqlite) return them unconverted.
+    _datetime_selects = ()
+
+    def _clone(self, *args, **kwargs):
+        c = super(EventQuerySet, self)._clone(*args, **kwargs)
+        c._datetime_selects = self._datetime_selects
+        return c
+
+    def iterator(self):
+        rows = super(EventQuerySet, self).iterator()
+        if not self._datetime_selects:
+            return rows
+        return self._convert_datetime_selects(rows)
+
+    def _convert_datetime_selects(self, rows):
+        ops = connections[self.db].ops
+        for obj in rows:
+            for name, field in self._datetime_selects:
+                value = getattr(obj, name)
+                if isinstance(value, basestring):
+                    setattr(obj, name, ops.convert_values(value, field))
+            yield obj
+
     def occurrences(self, *args, **kwargs):
         return self.model.Occurrence().objects.filter(event__in=self).filter(*args, **kwargs)
     
+    def with_occurrence_summary(self):
+        """
+        Annotates each event with a summary of its occurrences, in one grouped query:
+            first_start - the start of its first occurrence
+            last_end - the end of its last occurrence
+            occurrence_count - the number of occurrences
+            next_start - the start of its next occurrence that hasn't started yet
+        The datetimes are None for events without (upcoming) occurrences.
+        """
+        Occurrence = self.model.Occurrence()
+        opts = Occurrence._meta
+        qn = connections[self.db].ops.quote_name
+        # a correlated subquery, so that "now" is a query parameter.
+        next_start = """SELECT MIN(n.%(start)s) FROM %(table)s n
+            WHERE n.%(event)s = %(events)s.%(pk)s AND n.%(start)s >= %%s""" % {
+            'start': qn(opts.get_field('start').column),
+            'table': qn(opts.db_table),
+            'event': qn(opts.get_field('event').column),
+            'events': qn(self.model._meta.db_table),
+            'pk': qn(self.model._meta.pk.column),
+        }
+        qs = self.annotate(
+            first_start=Min('occurrences__start'),
+            last_end=Max('occurrences__end'),
+            occurrence_count=Count('occurrences'),
+        ).extra(select={'next_start': next_start}, select_params=(quantized_now(settings.NOW_QUANTUM),))
+        qs._datetime_selects = qs._datetime_selects + (('next_start', opts.get_field('start')),)
+        return qs
+
+    def _edge_occurrences(self, last=False):
+        """
+        The first (or last) occurrence of each event, in (start, end, id) order, in one statement however many
+        events there are.
+        """
+        qs = self.occurrences()
+        qs.query.where.add(_EdgeOccurrenceWhere(qs.model, qs.query.get_initial_alias(), last), AND)
+        return qs
+
     def opening_occurrences(self):
-        pks = []
-        for e in self:
-            try:
-                pks.append(e.opening_occurrence().id)
-            except AttributeError:
-                pass
-        return self.occurrences(pk__in=pks)
-        
+        return self._edge_occurrences()
+
+    def _span_between(self, field, d1=None, d2=None):
+        """
+        Filters on a stored span field (see EventMeta.occurrence_span), with the same bounds as starts_between().
+        """
+        qs = self
+        if d1 is not None:
+            qs = qs.filter(**{'%s__gte' % field: datetimeify(d1, clamp="min")})
+        if d2 is not None:
+            qs = qs.filter(**{'%s__lte' % field: datetimeify(d2, clamp="max")})
+        return qs
+
     def opening_before(self, date):
+        if self.model._event_meta.occurrence_span:
+            return self._span_between('opening_start', d2=date)
         return self.opening_occurrences().before(date).events()
     def opening_after(self, date):
+        if self.model._event_meta.occurrence_span:
+            return self._span_between('opening_start', d1=date)
         return self.opening_occurrences().after(date).events()
     def opening_between(self, d1, d2):
+        if self.model._event_meta.occurrence_span:
+            return self._span_between('opening_start', d1, d2)
         return self.opening_occurrences().between(d1, d2).events()
     def opening_on(self, date):
+        if self.model._event_meta.occurrence_span:
+            return self._span_between('opening_start', *dayify(date))
         return self.opening_occurrences().on(date).events()
 
     def closing_occurrences(self):
-        pks = []
-        for e in self:
-            try:
-                pks.append(e.closing_occurrence().id)
-            except AttributeError:
-                pass
-        return self.occurrences(pk__in=pks)
-        
+        return self._edge_occurrences(last=True)
+
     def closing_before(self, date):
+        if self.model._event_meta.occurrence_span:
+            return self._span_between('closing_start', d2=date)
         return self.closing_occurrences().before(date).events()
     def closing_after(self, date):
+        if self.model._event_meta.occurrence_span:
+            return self._span_between('closing_start', d1=date)
         return self.closing_occurrences().after(date).events()
     def closing_between(self, d1, d2):
+        if self.model._event_meta.occurrence_span:
+            return self._span_between('closing_start', d1, d2)
         return self.closing_occurrences().between(d1, d2).events()
     def closing_on(self, date):
+        if self.model._event_meta.occurrence_span:
+            return self._span_between('closing_start', *dayify(date))
         return self.closing_occurrences().on(date).events()
 
-    def _with_relatives_having(self, relatives_fn, *args, **kwargs):
+    def _relatives_having(self, relation, negated, *args, **kwargs):
+        """
+        Return the items in self that have (or, if negated, have no) relatives matching a particular criteria, in one
+        statement: see _RelativesWhere for the relations.
+        """
+        if relation == 'parent':
+            matches = self.filter(*args, **kwargs) # as before, the parent must be in self too
+        else:
+            matches = self.model._tree_manager.filter(*args, **kwargs)
+        qs = self._clone()
+        qs.query.where.add(_RelativesWhere(self.model, qs.query.get_initial_alias(), relation, matches, negated), AND)
+        return qs
+
+    def _with_relatives_having(self, relation, *args, **kwargs):
         """
         Return the set of items in self that have relatives matching a particular criteria.
         """
-        match_ids = set()
-        for obj in self:
-            matches = relatives_fn(obj)
-            if matches.count(): #weird bug where filter returns results on an empty qs!
-                matches = matches.filter(*args, **kwargs)
-                if matches.count():
-                    match_ids.add(obj.id)
-        return self.filter(id__in=match_ids)
+        return self._relatives_having(relation, False, *args, **kwargs)
 
     def with_children_having(self, *args, **kwargs):
-        return self._with_relatives_having(lambda x: x.get_children(), *args, **kwargs)
+        return self._with_relatives_having('children', *args, **kwargs)
         
     def with_descendants_having(self, *args, **kwargs):
         include_self = kwargs.pop('include_self', True)
-        return self._with_relatives_having(lambda x: x.get_descendants(include_self=include_self), *args, **kwargs)
+        return self._with_relatives_having('self_and_descendants' if include_self else 'descendants', *args, **kwargs)
 
     def with_parent_having(self, *args, **kwargs):
-        return self._with_relatives_having(lambda x: self.filter(id=x.parent_id), *args, **kwargs)
+        return self._with_relatives_having('parent', *args, **kwargs)
 
     def with_ancestors_having(self, *args, **kwargs):
-        return self._with_relatives_having(lambda x: x.get_ancestors(), *args, **kwargs)
+        return self._with_relatives_having('ancestors', *args, **kwargs)
 
-    def _without_relatives_having(self, relatives_fn, *args, **kwargs):
+    def _without_relatives_having(self, relation, *args, **kwargs):
         """
         Return the set of items in self that have 0 relatives matching a particular criteria.
         """
-        match_ids = set()
-        for obj in self:
-            matches = relatives_fn(obj)
-            if matches.count(): #weird bug where filter returns results on an empty qs!
-                matches = matches.filter(*args, **kwargs)
-                if matches.count() == 0:
-                    match_ids.add(obj.id)
-            else: #no relatives => win
-                    match_ids.add(obj.id)                
-        return self.filter(id__in=match_ids)
+        return self._relatives_having(relation, True, *args, **kwargs)
         
     def without_children_having(self, *args, **kwargs):
-        return self._without_relatives_having(lambda x: x.get_children(), *args, **kwargs)
+        return self._without_relatives_having('children', *args, **kwargs)
 
     def without_descendants_having(self, *args, **kwargs):
         include_self = kwargs.pop('include_self', True)
-        return self._without_relatives_having(lambda x: x.get_descendants(include_self=include_self), *args, **kwargs)
+        return self._without_relatives_having('self_and_descendants' if include_self else 'descendants', *args, **kwargs)
 
     def without_parent_having(self, *args, **kwargs):
-        return self._without_relatives_having(lambda x: self.filter(id=x.parent_id), *args, **kwargs)
+        return self._without_relatives_having('parent', *args, **kwargs)
 
     def without_ancestors_having(self, *args, **kwargs):
-        return self._without_relatives_having(lambda x: x.get_ancestors(), *args, **kwargs)
+        return self._without_relatives_having('ancestors', *args, **kwargs)
         
     #some simple annotations
     def having_occurrences(self):
@@ -121,11 +281,27 @@ class EventQuerySet(models.query.QuerySet):
         
         This is a good first blush at 'The List Of Events', since it is the longest list of events whose descendants'
         occurrences will cover the entire set of occurrences with no repetitions.
+
+        The trees of the events in self are read in one pass, in (tree_id, lft) order with their occurrence counts: the
+        first event in each subtree that has occurrences is one of the highest, and the rest of its subtree is skipped.
+        The result is self filtered on the ids found.
         """
-        return self.having_occurrences()._without_relatives_having(
-            lambda x: x.get_ancestors().annotate(num_occurrences=Count('occurrences')),
-            num_occurrences__gt=0
-        )
+        opts = self.model._mptt_meta
+        rows = self.model._tree_manager.filter(**{
+            '%s__in' % opts.tree_id_attr: self.values(opts.tree_id_attr),
+        }).order_by().values_list('pk', opts.tree_id_attr, opts.left_attr, opts.right_attr).annotate(
+            num_occurrences=Count('occurrences'),
+        ).order_by(opts.tree_id_attr, opts.left_attr)
+
+        ids = []
+        skip_tree = skip_right = None
+        for pk, tree_id, left, right, num_occurrences in rows.iterator():
+            if tree_id == skip_tree and left < skip_right:
+                continue
+            if num_occurrences:
+                ids.append(pk)
+                skip_tree, skip_right = tree_id, right
+        return self.filter(pk__in=ids)
 
 
 class EventTreeManager(TreeManager):
@@ -135,6 +311,8 @@ class EventTreeManager(TreeManager):
         
     def occurrences(self, *args, **kwargs):
         return self.get_query_set().occurrences(*args, **kwargs)
+    def with_occurrence_summary(self):
+        return self.get_query_set().with_occurrence_summary()
 
     def opening_before(self, *args, **kwargs):
         return self.get_query_set().opening_before(*args, **kwargs)
@@ -185,10 +363,15 @@ class EventOptions(object):
         class EventMeta:
             fields_to_inherit = ['name', 'slug', 'description']
         ...     
+
+    With occurrence_span = True, the model gets indexed opening_start, closing_start and closing_end fields: the first
+    start, last start and last end of its occurrences, kept up to date as occurrences are saved, generated and deleted.
+    The opening_* and closing_* queries then filter on them directly.
     """
     
     fields_to_inherit = []
     event_manager_attr = 'eventobjects'
+    occurrence_span = False
     
     def __init__(self, opts):
         # Override defaults with options provided
@@ -197,13 +380,38 @@ class EventOptions(object):
                 setattr(self, key, value)
 
 
+OCCURRENCE_SPAN_FIELDS = ('opening_start', 'closing_start', 'closing_end')
+
+class OccurrenceSpanField(models.DateTimeField):
+    """
+    A stored occurrence span datetime (see EventMeta.occurrence_span). The occurrences keep it up to date, so saving an
+    existing event leaves the stored value alone rather than writing back the one the instance was loaded with.
+    """
+    def pre_save(self, model_instance, add):
+        if add:
+            return super(OccurrenceSpanField, self).pre_save(model_instance, add)
+        return models.F(self.name)
+
+_local = threading.local()
+
+def _events_deleting():
+    """
+    The (model, pk)s of the events being deleted in this thread. Their occurrences are deleted with them, so the
+    occurrence spans aren't maintained as each one goes (see OccurrenceModel._update_event_span).
+    """
+    if not hasattr(_local, 'deleting_events'):
+        _local.deleting_events = set()
+    return _local.deleting_events
+
 class EventModelBase(MPTTModelBase):
     def __new__(meta, class_name, bases, class_dict):
         """
         Create subclasses of EventModel. This:
          - (via super) adds the MPTT fields to the class
+         - notes the fields_to_inherit that children take from their parent
          - adds the EventManager to the model
          - overrides MPTT's TreeManager to the model
+         - adds the occurrence span fields, if EventMeta.occurrence_span is set
         """
         event_opts = class_dict.pop('EventMeta', None)
         class_dict['_event_meta'] = EventOptions(event_opts)
@@ -218,13 +426,25 @@ class EventModelBase(MPTTModelBase):
             # copies)
             pass
         else:
+            #the fields whose values children take from the parent they're created with (see EventModel.__init__)
+            inherited = []
             for field_name in class_dict['_event_meta'].fields_to_inherit:
                 try:
                     field = cls._meta.get_field(field_name)
-                    #injecting our fancy inheriting default
-                    field.default = ModelInstanceAwareDefault(field_name, field.default)
                 except models.FieldDoesNotExist:
                     continue
+                if not isinstance(field, models.ManyToManyField):
+                    inherited.append((field.name, field.attname))
+            cls._inherited_fields = inherited
+
+            if class_dict['_event_meta'].occurrence_span:
+                for field_name in OCCURRENCE_SPAN_FIELDS:
+                    try:
+                        cls._meta.get_field(field_name)
+                    except models.FieldDoesNotExist:
+                        cls.add_to_class(field_name, OccurrenceSpanField(null=True, blank=True, editable=False, db_index=True))
+                signals.pre_delete.connect(cls._pre_delete, sender=cls)
+                signals.post_delete.connect(cls._post_delete, sender=cls)
                 
             # Add a custom manager
             manager = EventTreeManager(cls._mptt_meta) #since EventTreeManager subclasses TreeManager, it also needs the mptt options
@@ -245,23 +465,93 @@ class EventModel(MPTTModel):
 
     class Meta:
         abstract = True
+
+    _inherited_fields = []
+
+    def __init__(self, *args, **kwargs):
+        """
+        An event created with a parent takes the parent's values of fields_to_inherit that aren't given.
+        """
+        parent = kwargs.get('parent')
+        if parent is not None and self._inherited_fields:
+            given = set(f.attname for f in self._meta.fields[:len(args)])
+            for name, attname in self._inherited_fields:
+                if name not in kwargs and attname not in kwargs and attname not in given:
+                    kwargs[attname] = getattr(parent, attname)
+        super(EventModel, self).__init__(*args, **kwargs)
     
     def update_endless_generators(self):
-    
-        
+        """
+        Extend this event's endless generators to the horizon. Saving an event doesn't do this - the
+        `extend_generators` management command does it for all events.
+        """
         if hasattr(self, 'generators'):
             endless_generators = self.generators.filter(rule__isnull=False, repeat_until__isnull=True)
             [g.generate() for g in endless_generators]
     
     def save(self, *args, **kwargs):
         self.cascade_changes_to_children()
-        self.update_endless_generators()
         return super(EventModel, self).save(*args, **kwargs)
                 
     @classmethod
     def Occurrence(cls):
         return cls.occurrences.related.model
 
+    @staticmethod #connected in the metaclass
+    def _pre_delete(sender, **kwargs):
+        _events_deleting().add((sender, kwargs['instance'].pk))
+
+    @staticmethod #connected in the metaclass
+    def _post_delete(sender, **kwargs):
+        _events_deleting().discard((sender, kwargs['instance'].pk))
+
+    @classmethod
+    def update_occurrence_spans(cls, event_ids):
+        """
+        Recalculates the stored occurrence span (see EventMeta.occurrence_span) of the given events from their
+        occurrences, with one query and then an UPDATE per event.
+        """
+        event_ids = set(event_ids)
+        if not cls._event_meta.occurrence_span or not event_ids:
+            return
+        spans = dict((row.pop('event'), row) for row in cls.Occurrence()._default_manager.filter(
+            event__in=event_ids,
+        ).order_by().values('event').annotate(
+            opening_start=Min('start'),
+            closing_start=Max('start'),
+            closing_end=Max('end'),
+        ))
+        for event_id in event_ids:
+            span = spans.get(event_id, {})
+            cls._event_manager.filter(pk=event_id).update(**dict((f, span.get(f)) for f in OCCURRENCE_SPAN_FIELDS))
+
+    @classmethod
+    def extend_occurrence_span(cls, event_id, opening_start, closing_start, closing_end):
+        """
+        Widens the stored occurrence span of an event to cover new occurrences (from opening_start to closing_start,
+        ending by closing_end), in one UPDATE that doesn't read the existing occurrences.
+        """
+        if not cls._event_meta.occurrence_span:
+            return
+        using = router.db_for_write(cls)
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        sql = """UPDATE %(table)s SET
+            %(opening_start)s = CASE WHEN %(opening_start)s IS NULL OR %(opening_start)s > %%s THEN %%s ELSE %(opening_start)s END,
+            %(closing_start)s = CASE WHEN %(closing_start)s IS NULL OR %(closing_start)s < %%s THEN %%s ELSE %(closing_start)s END,
+            %(closing_end)s = CASE WHEN %(closing_end)s IS NULL OR %(closing_end)s < %%s THEN %%s ELSE %(closing_end)s END
+            WHERE %(pk)s = %%s""" % dict(
+            [(f, qn(cls._meta.get_field(f).column)) for f in OCCURRENCE_SPAN_FIELDS],
+            table=qn(cls._meta.db_table),
+            pk=qn(cls._meta.pk.column),
+        )
+        params = []
+        for value in (opening_start, closing_start, closing_end):
+            value = connection.ops.value_to_db_datetime(value)
+            params += [value, value]
+        connection.cursor().execute(sql, params + [event_id])
+        transaction.commit_unless_managed(using=using)
+
     @classmethod
     def Generator(cls):
         if hasattr(cls, 'generators'):
@@ -275,23 +565,57 @@ class EventModel(MPTTModel):
         return type(self)._event_manager.get(pk=self.pk)
         
     def cascade_changes_to_children(self):
-        if self.pk:
-            saved_self = type(self)._event_manager.get(pk=self.pk)
-            attribs = type(self)._event_meta.fields_to_inherit
-        
-            for child in self.get_children():
-                for a in attribs:
-                    try:
-                        saved_value = getattr(saved_self, a)
-                        ch_value = getattr(child, a)
-                        if ch_value == saved_value: #the child inherits this value from the parent
-                            new_value = getattr(self, a)
-                            setattr(child, a, new_value)
-                    except AttributeError:
-                        continue
-                child.save() #cascades to grandchildren
+        """
+        Copies this event's changes to fields_to_inherit down to the descendants that inherit them: those that, like
+        every event between them and this one, still have this event's saved value.
+
+        This is one UPDATE per changed field, over this event's (lft, rght) range, so the descendants aren't loaded or
+        saved (nor are their save signals sent). Cached occurrence queries are invalidated once at the end.
+        """
+        if not self.pk:
+            return
+        cls = type(self)
+        fields = []
+        for a in cls._event_meta.fields_to_inherit:
+            try:
+                field = cls._meta.get_field(a)
+            except models.FieldDoesNotExist:
+                continue
+            if not isinstance(field, models.ManyToManyField):
+                fields.append(field)
+        if not fields:
+            return
+
+        opts = cls._mptt_meta
+        saved = list(cls._event_manager.filter(pk=self.pk).values(
+            opts.tree_id_attr, opts.left_attr, opts.right_attr, *[f.name for f in fields]))
+        if not saved:
+            return
+        saved = saved[0]
+        below = {
+            opts.tree_id_attr: saved[opts.tree_id_attr],
+            '%s__gt' % opts.left_attr: saved[opts.left_attr],
+            '%s__lt' % opts.left_attr: saved[opts.right_attr],
+        }
+        can_self_select = connections[router.db_for_write(cls)].features.update_can_self_select
+
+        changed = False
+        for field in fields:
+            old_value, new_value = saved[field.name], getattr(self, field.attname)
+            if old_value == new_value:
+                continue
+            inheriting = cls._event_manager.filter(**below).filter(**{field.name: old_value}).without_ancestors_having(
+                ~models.Q(**{field.name: old_value}), **below)
+            if not can_self_select: #eg MySQL can't UPDATE a table filtered on a subquery of itself
+                inheriting = cls._event_manager.filter(pk__in=list(inheriting.values_list('pk', flat=True)))
+            changed = inheriting.update(**{field.name: new_value}) or changed
+
+        if changed and hasattr(cls, 'occurrences'):
+            cls.Occurrence().invalidate_query_cache()
                 
     def has_occurrences(self):
+        if hasattr(self, 'occurrence_count'): #from with_occurrence_summary()
+            return self.occurrence_count
         return self.occurrences.count()
         
     def opening_occurrence(self):
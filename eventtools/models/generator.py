@@ -1,22 +1,86 @@
 # −*− coding: UTF−8 −*−
 from django.db import models, transaction
 from django.db.models.base import ModelBase
+from django.db.models.sql import DeleteQuery
 from django.utils.translation import ugettext, ugettext_lazy as _
 from django.core import exceptions
 
 from dateutil import rrule
 
-from rule import Rule
+from rule import Rule, rruleset_after
+from occurrence import _generators_deleting_quietly
 
 from nosj.fields import JSONField
 
-from eventtools.utils import datetimeify
+from eventtools.utils import datetimeify, parse_isoformat
 from eventtools.conf import settings
 from eventtools.utils.pprint_timespan import (
     pprint_datetime_span, pprint_date_span)
 
 from datetime import date, time, datetime, timedelta
 
+def _plus(field, delta):
+    """
+    An F() expression that adds a timedelta to a datetime field. Negative timedeltas are subtracted instead, since not
+    every backend handles negative intervals.
+    """
+    if delta < timedelta(0):
+        return models.F(field) - (-delta)
+    return models.F(field) + delta
+
+def _occurrences_between(generators, start, end):
+    """
+    Returns the occurrences of `generators` that start between `start` and `end`, sorted: the stored ones, plus unsaved
+    ones for the dates that virtual generators produce in the window that aren't already stored (by the generator, or
+    for its event).
+    """
+    if not generators:
+        return []
+    Occurrence = generators[0].Occurrence()
+    occurrences = list(Occurrence._default_manager.filter(generator__in=[g.pk for g in generators], start__gte=start, start__lte=end))
+
+    virtual_generators = [g for g in generators if g.virtual]
+    if virtual_generators:
+        generator_spans, event_spans = set(), set()
+        for generator_id, event_id, s, e in Occurrence._default_manager.filter(
+                models.Q(generator__in=[g.pk for g in virtual_generators]) | models.Q(event__in=[g.event_id for g in virtual_generators]),
+                start__gte=start, start__lte=end).values_list('generator', 'event', 'start', 'end'):
+            generator_spans.add((generator_id, s, e))
+            event_spans.add((event_id, s, e))
+        for g in virtual_generators:
+            for s, e in g.window_spans(start, end):
+                if (g.pk, s, e) not in generator_spans and (g.event_id, s, e) not in event_spans:
+                    occurrences.append(g.virtual_occurrence(s, e))
+
+    occurrences.sort(key=lambda o: (o.start, o.end))
+    return occurrences
+
+class GeneratorQuerySet(models.query.QuerySet):
+    def occurrences_between(self, start, end):
+        """
+        Returns the occurrences of these generators that start between `start` and `end`, including the unsaved ones
+        of virtual generators. Returns a list, since they aren't all in the database.
+        """
+        start = datetimeify(start, clamp="min")
+        end = datetimeify(end, clamp="max")
+        generators = list(self.filter(event_start__lte=end).filter(
+            models.Q(repeat_until__isnull=True) | models.Q(repeat_until__gte=start)
+        ).select_related('rule', 'event'))
+        return _occurrences_between(generators, start, end)
+
+class GeneratorManager(models.Manager):
+    def get_query_set(self):
+        return GeneratorQuerySet(self.model)
+
+    def occurrences_between(self, *args, **kwargs):
+        return self.get_query_set().occurrences_between(*args, **kwargs)
+
+def generator_models():
+    """
+    Returns the installed (concrete) subclasses of GeneratorModel.
+    """
+    return [m for m in models.get_models() if issubclass(m, GeneratorModel)]
+
 class GeneratorModel(models.Model):
     """
     A GeneratorModel generates Occurrences according to given rules. For example:
@@ -31,7 +95,15 @@ class GeneratorModel(models.Model):
     generate all occurrences that start before the `repeat_until` datetime limit.
 
     Generators without repeat_until limits potentially repeat infinitely. In this case, we generate occurrences until a
-    set timedelta in the future. This timedelta is set in the setting 'DEFAULT_GENERATOR_LIMIT'.    
+    set timedelta in the future. This timedelta is set in the setting 'DEFAULT_GENERATOR_LIMIT'. To keep them
+    generating as time passes, run the `extend_generators` management command regularly (eg daily from cron).
+
+    The `materialized_until` watermark records how far occurrences have been generated, so that extending the horizon
+    only expands and inserts the new dates.
+
+    Virtual generators don't store their occurrences at all. Instead, occurrences_between() expands the rule for the
+    requested window, and only occurrences that are edited or cancelled (ie saved) are stored. This suits rules that
+    repeat hourly or daily forever.
     """
 
     #define a field called 'event' in the subclass
@@ -40,6 +112,13 @@ class GeneratorModel(models.Model):
     rule = models.ForeignKey(Rule, verbose_name=_("repetition rule"), null = True, blank = True, help_text=_("Select '----' for a one-off event."))
     repeat_until = models.DateTimeField(null = True, blank = True, help_text=_("These start dates are ignored for one-off events."))
     exceptions = JSONField(null=True, blank=True, help_text="These dates are skipped by the generator.", default={})
+    materialized_until = models.DateTimeField(null=True, blank=True, editable=False, help_text=_("Occurrences starting up to this datetime have already been generated."))
+    virtual = models.BooleanField(_("virtual"), default=False, help_text=_("Don't store occurrences unless they are edited. Useful for rules that repeat very often."))
+
+    objects = GeneratorManager()
+
+    # created on syncdb, see indexes.composite_index_sql
+    _composite_indexes = (('event', 'event_start', 'event_end'),)
     
     class Meta:
         abstract = True
@@ -60,12 +139,17 @@ class GeneratorModel(models.Model):
         if self.repeat_until is not None and self.rule is None:
             raise exceptions.ValidationError(
                 'repeat_until has no effect without a repetition rule')
+        if settings.OCCURRENCE_MAX_DURATION is not None and \
+                self.event_end - self.event_start > settings.OCCURRENCE_MAX_DURATION:
+            raise exceptions.ValidationError(
+                'occurrences must not last longer than %s' % settings.OCCURRENCE_MAX_DURATION)
         super(GeneratorModel, self).clean()
 
 
     @transaction.commit_on_success()
     def save(self, *args, **kwargs):
         generate = kwargs.pop('generate', True)
+        diff = kwargs.pop('diff', settings.GENERATOR_DIFF_ON_CHANGE)
         
         if self.event_end is None:
             self.event_end = self.event_start
@@ -87,6 +171,9 @@ class GeneratorModel(models.Model):
         if self.repeat_until is not None and self.rule is None:
             raise AttributeError('repeat_until has no effect without a repetition rule')
 
+        if settings.OCCURRENCE_MAX_DURATION is not None and self.event_duration > settings.OCCURRENCE_MAX_DURATION:
+            raise AttributeError('occurrences must not last longer than %s' % settings.OCCURRENCE_MAX_DURATION)
+
         """
         When you change a generator and save it, it updates its existing occurrences according to the following:
         
@@ -97,6 +184,10 @@ class GeneratorModel(models.Model):
             don't try to delete out-of-bounds occurrences, but run generate() to make the new occurrences.
             out-of-bounds occurrences are left behind.
             ie update as normal
+
+        * Unless saving with diff=True (or GENERATOR_DIFF_ON_CHANGE is set), in which case when the rule or
+          repeat_until was changed, the occurrences that the old settings generated and the new ones don't are
+          deleted, as long as they haven't been edited (see _untouched_occurrences).
             
         * If start date (or datetime) was changed:
             run the old rule, and timeshift all occurrences produced by the old rule.
@@ -113,37 +204,141 @@ class GeneratorModel(models.Model):
         
         if self.pk: #it already exists so could potentially be changed
             saved_self = type(self).objects.get(pk=self.pk)
+            if self.rule != saved_self.rule or self.event_start != saved_self.event_start or \
+                    self.event_end != saved_self.event_end:
+                # the dates generated so far are no longer the ones the rule produces.
+                self.materialized_until = None
+
             if self.rule == saved_self.rule:
                 start_shift = self.event_start - saved_self.event_start
                 end_shift = self.event_end - saved_self.event_end
                 duration = self.event_duration
+                spans = self.occurrences.values_list('pk', 'start', 'end')
 
                 if start_shift:
                     if self.event_start.date() != saved_self.event_start.date(): # we're shifting days (and times)
-                        occurrence_set = self.occurrences.filter(start__in=list(saved_self.generate_dates()))
+                        dates = set(saved_self.generate_dates())
+                        spans = [span for span in spans if span[1] in dates]
                     elif self.event_start.time() != saved_self.event_start.time(): #we're only shifting times
-                        occurrence_set = [o for o in self.occurrences.all() if o.start.time() == saved_self.event_start.time()]
+                        start_time = saved_self.event_start.time()
+                        spans = [span for span in spans if span[1].time() == start_time]
+                    else:
+                        spans = []
 
-                    for occ in occurrence_set:
-                        occ.start += start_shift
-                        occ.end = occ.start + duration
-                        occ.save()
+                    self._timeshift_occurrences(
+                        [(pk, start, end, start + start_shift, start + start_shift + duration) for pk, start, end in spans],
+                        start=_plus('start', start_shift),
+                        end=_plus('start', start_shift + duration),
+                    )
 
                 elif end_shift: #only end has changed (both is covered above)            
                     if self.event_end.date() != saved_self.event_end.date(): # we're shifting days (and times)
-                        occurrence_set = self.occurrences.filter(start__in=list(self.generate_dates()))
+                        dates = set(self.generate_dates())
+                        spans = [span for span in spans if span[1] in dates]
                     elif self.event_end.time() != saved_self.event_end.time(): #we're only shifting times
-                        occurrence_set = [o for o in self.occurrences.all() if o.end.time() == saved_self.event_end.time()]
-
-                    for occ in occurrence_set:
-                        occ.end += end_shift
-                        occ.save()
+                        end_time = saved_self.event_end.time()
+                        spans = [span for span in spans if span[2].time() == end_time]
+                    else:
+                        spans = []
+
+                    self._timeshift_occurrences(
+                        [(pk, start, end, start, end + end_shift) for pk, start, end in spans],
+                        end=_plus('end', end_shift),
+                    )
+
+            if diff and (self.rule != saved_self.rule or self.repeat_until != saved_self.repeat_until):
+                old_self = saved_self
+                if self.rule == saved_self.rule: # the occurrences have been timeshifted to the new times
+                    old_self.event_start, old_self.event_end = self.event_start, self.event_end
+                self._delete_occurrences(self._untouched_occurrences(old_self.expand() - self.expand()))
                 
 
         super(GeneratorModel, self).save(*args, **kwargs)
         if generate:
             self.generate() #need to do this after save, so we have ids.
     
+    def _timeshift_occurrences(self, spans, **updates):
+        """
+        Applies `updates` (F() expressions for start and/or end) to the occurrences in `spans`, a list of (pk, start,
+        end, new start, new end), in a few UPDATE statements.
+
+        Then makes the same changes to exceptions that saving each occurrence would (see OccurrenceModel.save), in
+        memory, to be saved with the generator: the old start of each changed occurrence becomes an exception, and
+        new starts that match the generator's duration stop being exceptions.
+        """
+        if not spans:
+            return
+
+        Occurrence = self.Occurrence()
+        pks = [span[0] for span in spans]
+        batch_size = settings.GENERATOR_BATCH_SIZE
+        for i in range(0, len(pks), batch_size):
+            Occurrence._default_manager.filter(pk__in=pks[i:i+batch_size]).update(**updates)
+        Occurrence._update_days([(pk, new_start, new_end) for pk, start, end, new_start, new_end in spans])
+        Occurrence.invalidate_query_cache()
+        Occurrence.Event().update_occurrence_spans([self.event_id])
+
+        if self.exceptions is None:
+            self.exceptions = {}
+        for pk, start, end, new_start, new_end in spans:
+            if (start, end) != (new_start, new_end):
+                self.exceptions[start.isoformat()] = True
+        duration = self.event_duration
+        for pk, start, end, new_start, new_end in spans:
+            if new_end - new_start == duration:
+                self.exceptions.pop(new_start.isoformat(), None)
+
+    def _untouched_occurrences(self, spans):
+        """
+        Returns the pks of this generator's occurrences whose (start, end) is in `spans` and that haven't been edited:
+        they are still for the generator's event, and their other fields (eg a status or notes added by a subclass)
+        still have the default values they were generated with. Fields set automatically (auto_now) are ignored.
+        """
+        Occurrence = self.Occurrence()
+        fields = [f for f in Occurrence._meta.local_fields if not f.primary_key
+            and f.name not in ('start', 'end', 'event', 'generator')
+            and not getattr(f, 'auto_now', False) and not getattr(f, 'auto_now_add', False)]
+        defaults = tuple(f.get_default() for f in fields)
+        rows = self.occurrences.values_list('pk', 'start', 'end', 'event', *[f.name for f in fields])
+        return [row[0] for row in rows
+            if (row[1], row[2]) in spans and row[3] == self.event_id and tuple(row[4:]) == defaults]
+
+    def _delete_occurrences(self, pks):
+        """
+        Deletes occurrences by pk, in batches, without adding exceptions. Batches that nothing but the day buckets
+        refers to are deleted directly, without loading them or sending signals. The rest are deleted normally, so that
+        related objects are cascaded.
+        """
+        if not pks:
+            return
+        Occurrence = self.Occurrence()
+        Day = Occurrence._occurrence_meta.day_model
+        related = [r for r in Occurrence._meta.get_all_related_objects() + \
+            Occurrence._meta.get_all_related_many_to_many_objects() if r.model is not Day]
+        batch_size = settings.GENERATOR_BATCH_SIZE
+        cascaded, direct = [], []
+        for i in range(0, len(pks), batch_size):
+            batch = pks[i:i+batch_size]
+            if [r for r in related if r.model._base_manager.filter(**{'%s__in' % r.field.name: batch}).exists()]:
+                cascaded.append(batch)
+            else:
+                direct.extend(batch)
+
+        if cascaded:
+            quiet = _generators_deleting_quietly()
+            quiet.add(self.pk)
+            try:
+                for batch in cascaded:
+                    Occurrence._default_manager.filter(pk__in=batch).delete()
+            finally:
+                quiet.discard(self.pk)
+        if direct:
+            if Day is not None:
+                DeleteQuery(Day).delete_batch(direct, Day._default_manager.db, field=Day._meta.get_field('occurrence'))
+            DeleteQuery(Occurrence).delete_batch(direct, Occurrence._default_manager.db)
+            Occurrence.invalidate_query_cache()
+            Occurrence.Event().update_occurrence_spans([self.event_id])
+
     @property
     def all_day(self):
         return self.event_start.time() == time.min and self.event_end.time() == time.max
@@ -169,31 +364,176 @@ class GeneratorModel(models.Model):
                     occ = self.occurrences.create(event=self.event, start=start, end=end) #generator = self
                     return occ
 
-    def generate_dates(self):
+    def expand(self, until=None):
+        """
+        Returns the set of (start, end) pairs this generator produces, up to `until` (by default, the horizon).
+        """
+        if self.rule is None:
+            if self.is_exception(self.event_start):
+                return set()
+            return set([(self.event_start, self.event_end)])
+        duration = self.event_duration
+        return set((d, d + duration) for d in self.generate_dates(until=until))
+
+    def rruleset(self, after=None):
+        """
+        Returns the rule's rruleset from event_start, with the exceptions excluded. If `after` is given, the rules
+        are expanded from around then instead (see rule.rruleset_after), so dates before it may or may not be included.
+        """
         rule = self.rule.get_rrule(dtstart=self.event_start)
-        date_iter = iter(rule)
-        drop_dead_date = self.repeat_until or datetime.now() + settings.DEFAULT_GENERATOR_LIMIT
+        if after is not None and after > self.event_start:
+            rule = rruleset_after(rule, after)
+        naive = self.event_start.tzinfo is None
+        for exdate in self.exception_dates():
+            if naive and exdate.tzinfo is not None:
+                exdate = exdate.replace(tzinfo=None) #keyed by an aware datetime in the same local time
+            rule.exdate(exdate)
+        return rule
+
+    def window_spans(self, start, end):
+        """
+        Returns the (start, end) pairs this generator produces that start between `start` and `end`. The rule is
+        expanded from around `start` (see rruleset), so the cost depends on the size of the window rather than on how
+        far it is from event_start, except for rules with a count.
+        """
+        if self.rule is None:
+            if start <= self.event_start <= end and not self.is_exception(self.event_start):
+                return [(self.event_start, self.event_end)]
+            return []
+        if self.repeat_until is not None and self.repeat_until < end:
+            end = self.repeat_until
+        duration = self.event_duration
+        return [(d, d + duration) for d in self.rruleset(after=start).between(start, end, inc=True)]
+
+    def virtual_occurrence(self, start, end):
+        """
+        Returns an unsaved occurrence of this generator. Saving it stores it, and if its start or end has been changed,
+        the generated start becomes an exception (see OccurrenceModel.save).
+        """
+        occ = self.Occurrence()(generator=self, event=self.event, start=start, end=end)
+        occ._generated_span = (start, end)
+        return occ
+
+    def occurrences_between(self, start, end):
+        """
+        Returns this generator's occurrences that start between `start` and `end`, stored or (if virtual) not.
+        """
+        return _occurrences_between([self], datetimeify(start, clamp="min"), datetimeify(end, clamp="max"))
+
+    def horizon(self):
+        """
+        The datetime up to which occurrences are generated: repeat_until, or DEFAULT_GENERATOR_LIMIT from now for
+        generators that repeat endlessly.
+        """
+        return self.repeat_until or datetime.now() + settings.DEFAULT_GENERATOR_LIMIT
+
+    def generate_dates(self, after=None, until=None):
+        """
+        Yields the start datetimes produced by the rule, up to `until` (by default, the horizon). If `after` is given,
+        only the dates later than it are yielded, and the rule is expanded from then rather than from event_start.
+        Exceptions are excluded by the rruleset, so they are never produced.
+        """
+        date_iter = iter(self.rruleset(after=after))
+        drop_dead_date = until or self.horizon()
         
         while True:
             d = date_iter.next()
             if d > drop_dead_date:
                 break
+            if after is not None and d <= after:
+                continue
             yield d
 
     @transaction.commit_on_success()
-    def generate(self):
+    def generate(self, full=False, until=None):
         """
-        generate my occurrences
+        generate my occurrences, and return how many were created.
+
+        Only the dates after the `materialized_until` watermark are generated, unless `full` is True, in which case
+        the whole rule is checked again (eg to recreate occurrences that were deleted without becoming exceptions).
+
+        Pass `until` to stop short of the horizon (eg to extend an endless generator a step at a time).
         """
 
+        if self.virtual: #occurrences are made when they're asked for
+            return 0
+
         if self.rule is None: #the only occurrence in the village
-            self.create_occurrence(start=self.event_start, end=self.event_end, honour_exceptions=True)
-            return
+            return self.bulk_create_occurrences([(self.event_start, self.event_end)], honour_exceptions=True)
 
+        horizon = self.horizon()
+        if until is not None and until < horizon:
+            horizon = until
+        after = None if full else self.materialized_until
         event_duration = self.event_duration
-        for o_start in self.generate_dates():
-            o_end = o_start + event_duration
-            self.create_occurrence(start=o_start, end=o_end, honour_exceptions=True)
+        created = self.bulk_create_occurrences(
+            [(o_start, o_start + event_duration) for o_start in self.generate_dates(after=after, until=horizon)],
+        )
+
+        if horizon != self.materialized_until:
+            self.materialized_until = horizon
+            type(self)._default_manager.filter(pk=self.pk).update(materialized_until=horizon)
+        return created
+
+    def _existing_spans(self, first, last):
+        """
+        Returns the set of (start, end) pairs that start between `first` and `last` and that have already been saved
+        either by this generator (regardless of the event it is now assigned to) or for this generator's event
+        (regardless of the generator it came from). One query.
+        """
+        Occurrence = self.Occurrence()
+        return set(Occurrence._default_manager.filter(
+            models.Q(generator=self) | models.Q(event=self.event_id),
+            start__gte=first,
+            start__lte=last,
+        ).values_list('start', 'end'))
+
+    def bulk_create_occurrences(self, spans, honour_exceptions=False):
+        """
+        The batched equivalent of calling create_occurrence for each (start, end) pair in `spans`, with the same rules
+        about exceptions and duplicates.
+
+        The existing occurrences are read in one query, and only the missing ones are inserted, in chunks of
+        GENERATOR_BATCH_SIZE, so the number of queries doesn't depend on how many dates are checked.
+
+        Returns the number of occurrences created.
+        """
+        if honour_exceptions:
+            spans = [(start, end) for start, end in spans if not self.is_exception(start)]
+        if not spans:
+            return 0
+
+        starts = [start for start, end in spans]
+        seen = self._existing_spans(min(starts), max(starts))
+
+        Occurrence = self.Occurrence()
+        new_occurrences = []
+        for start, end in spans:
+            if (start, end) not in seen:
+                seen.add((start, end))
+                new_occurrences.append(Occurrence(generator=self, event_id=self.event_id, start=start, end=end))
+
+        batch_size = settings.GENERATOR_BATCH_SIZE
+        for i in range(0, len(new_occurrences), batch_size):
+            Occurrence._default_manager.bulk_create(new_occurrences[i:i+batch_size])
+
+        if new_occurrences and Occurrence._occurrence_meta.day_model is not None:
+            # bulk_create doesn't set pks, so the new occurrences are found again by their lack of day buckets.
+            Occurrence._update_days(list(Occurrence._default_manager.filter(
+                generator=self,
+                start__gte=min(starts),
+                start__lte=max(starts),
+                days__isnull=True,
+            ).values_list('pk', 'start', 'end')))
+        if new_occurrences:
+            Occurrence.invalidate_query_cache()
+            Occurrence.Event().extend_occurrence_span(
+                self.event_id,
+                min(o.start for o in new_occurrences),
+                max(o.start for o in new_occurrences),
+                max(o.end for o in new_occurrences),
+            )
+        return len(new_occurrences)
 
     def robot_description(self):
         if self.rule:
@@ -213,27 +553,56 @@ class GeneratorModel(models.Model):
 
     
     def is_exception(self, dt):
-        if self.exceptions is None:
-            self.reset_exceptions()
-        return self.exceptions.has_key(dt.isoformat())
+        return (self.exceptions or {}).has_key(dt.isoformat())
+
+    def exception_dates(self):
+        """
+        Returns the exceptions as datetimes.
+        """
+        return [parse_isoformat(k) for k in (self.exceptions or {})]
     
     def add_exception(self, dt):
+        self.add_exceptions([dt])
+
+    def add_exceptions(self, dts):
+        """
+        Adds many exceptions (eg a cancelled season) in a single write.
+        """
         if self.exceptions is None:
-            self.reset_exceptions()
-        
-        self.exceptions[dt.isoformat()] = True
-        self.save(generate=False)       
+            self.exceptions = {}
+        for dt in dts:
+            self.exceptions[dt.isoformat()] = True
+        self._save_exceptions()
 
     def remove_exception(self, dt):
+        self.remove_exceptions([dt])
+
+    def remove_exceptions(self, dts):
+        """
+        Removes many exceptions in a single write. Removed exceptions are generated the next time generate() is called.
+        """
         if self.exceptions is None:
-            self.reset_exceptions()
-        if self.is_exception(dt):
-            del self.exceptions[dt.isoformat()]
-            self.save(generate=False)
+            self.exceptions = {}
+        removed = [dt for dt in dts if self.exceptions.pop(dt.isoformat(), None) is not None]
+        if removed:
+            if self.materialized_until is not None and min(removed) <= self.materialized_until:
+                self.materialized_until = None # so the dates can be generated again
+            self._save_exceptions()
 
     def reset_exceptions(self):
         self.exceptions = {}
-        self.save(generate=False)
+        self.materialized_until = None
+        self._save_exceptions()
+
+    def _save_exceptions(self):
+        """
+        Writes exceptions (and the watermark, which they affect) without the rest of save().
+        """
+        if self.pk is None:
+            self.save(generate=False)
+        else:
+            type(self)._default_manager.filter(pk=self.pk).update(
+                exceptions=self.exceptions, materialized_until=self.materialized_until)
 
     def reload(self):
         """
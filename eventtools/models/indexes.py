@@ -0,0 +1,65 @@
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from django.db.backends.util import truncate_name
+from django.db.models import signals, get_models
+
+__all__ = ('composite_index_sql',)
+
+def _composite_indexes(model, connection):
+    """
+    Yields (index name, CREATE INDEX statement) for each of the multi-column indexes `model` lists in
+    _composite_indexes (a list of tuples of field names).
+    """
+    qn = connection.ops.quote_name
+    opts = model._meta
+    for field_names in getattr(model, '_composite_indexes', ()):
+        columns = [opts.get_field(name).column for name in field_names]
+        name = truncate_name('%s_%s' % (opts.db_table, '_'.join(columns)), connection.ops.max_name_length())
+        yield name, 'CREATE INDEX %s ON %s (%s);' % (qn(name), qn(opts.db_table), ', '.join(qn(c) for c in columns))
+
+def composite_index_sql(model, using=DEFAULT_DB_ALIAS):
+    """
+    Returns the CREATE INDEX statements for the multi-column indexes `model` lists in _composite_indexes (a list of
+    tuples of field names). Meta.index_together isn't available before Django 1.5, so these are created by a
+    post_syncdb handler when the model's table is created. Tables created by an earlier version of eventtools need
+    these statements run by hand.
+    """
+    return [sql for name, sql in _composite_indexes(model, connections[using])]
+
+def _index_names(connection, cursor, table):
+    """
+    The names of the indexes on `table`, lowercased, or None if the backend can't list them.
+    """
+    if connection.vendor == 'sqlite':
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = %s", [table])
+    elif connection.vendor == 'postgresql':
+        cursor.execute("SELECT indexname FROM pg_indexes WHERE tablename = %s", [table])
+    elif connection.vendor == 'mysql':
+        cursor.execute("SHOW INDEX FROM %s" % connection.ops.quote_name(table))
+        return set(row[2].lower() for row in cursor.fetchall())
+    elif connection.vendor == 'oracle':
+        cursor.execute("SELECT index_name FROM user_indexes WHERE table_name = UPPER(%s)", [table])
+    else:
+        return None
+    return set(row[0].lower() for row in cursor.fetchall())
+
+def create_composite_indexes(sender, app, created_models, verbosity=1, db=DEFAULT_DB_ALIAS, **kwargs):
+    """
+    Creates the composite indexes of the models in `app` that syncdb has just created. flush sends post_syncdb too,
+    for every model, so the indexes that are already there (and the tables that aren't) are skipped.
+    """
+    connection = connections[db]
+    cursor = connection.cursor()
+    tables = set(connection.introspection.table_names())
+    for model in get_models(app):
+        if model not in created_models or model._meta.db_table not in tables:
+            continue
+        existing = _index_names(connection, cursor, model._meta.db_table)
+        statements = [sql for name, sql in _composite_indexes(model, connection)
+            if existing is None or name.lower() not in existing]
+        if statements and verbosity >= 2:
+            print "Installing composite indexes for %s.%s model" % (model._meta.app_label, model._meta.object_name)
+        for sql in statements:
+            cursor.execute(sql)
+    transaction.commit_unless_managed(using=db)
+
+signals.post_syncdb.connect(create_composite_indexes)
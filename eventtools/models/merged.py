@@ -0,0 +1,269 @@
+import heapq
+from itertools import islice, count
+from datetime import timedelta
+
+from django.db import models
+
+from eventtools.models.occurrence import OccurrenceQuerySetFN
+
+__all__ = ('MergedOccurrenceQuerySet',)
+
+_MICROSECOND = timedelta(microseconds=1)
+
+def _narrow(bounds, op, value):
+    """
+    Narrows a [lower, upper] pair of inclusive bounds with a filter() lookup.
+    """
+    if op == 'gt':
+        op, value = 'gte', value + _MICROSECOND
+    elif op == 'lt':
+        op, value = 'lte', value - _MICROSECOND
+    if op in ('gte', '', 'exact'):
+        bounds[0] = value if bounds[0] is None else max(bounds[0], value)
+    if op in ('lte', '', 'exact'):
+        bounds[1] = value if bounds[1] is None else min(bounds[1], value)
+
+def _matches(occ, lookup, value):
+    """
+    Evaluates a (non-time) filter() lookup against an unsaved occurrence. Lookups across a foreign key are evaluated by
+    querying the related model.
+    """
+    parts = lookup.split('__')
+    field = occ._meta.get_field(parts[0])
+    if field.name in ('start', 'end'):
+        raise NotImplementedError("Times can only be filtered with start and end range lookups: %s" % lookup)
+    op = 'exact'
+    if len(parts) == 2 and parts[1] in ('exact', 'in', 'isnull'):
+        op = parts.pop()
+    if len(parts) != 1:
+        if getattr(field, 'rel', None) is None:
+            raise NotImplementedError("This lookup can't be applied to virtual occurrences: %s" % lookup)
+        related_id = getattr(occ, field.attname)
+        if related_id is None:
+            return parts[-1] == 'isnull' and bool(value)
+        return field.rel.to._default_manager.filter(**{'__'.join(parts[1:]): value}).filter(pk=related_id).exists()
+    actual = getattr(occ, field.attname)
+
+    def prep(v):
+        return v.pk if isinstance(v, models.Model) else v
+    if op == 'isnull':
+        return (actual is None) == bool(value)
+    if op == 'in':
+        return actual in [prep(v) for v in value]
+    return actual == prep(value)
+
+def _matches_q(occ, q):
+    """
+    Evaluates a Q object (of non-time lookups) against an unsaved occurrence.
+    """
+    results = (
+        _matches_q(occ, child) if isinstance(child, models.Q) else _matches(occ, *child) for child in q.children
+    )
+    matched = all(results) if q.connector == models.Q.AND else any(results)
+    return matched != q.negated
+
+def _spans(generator, lo, hi):
+    """
+    Lazily yields the (start, end) pairs `generator` produces that start between lo and hi (either may be None). The
+    rule is expanded from around lo.
+    """
+    if generator.rule is None:
+        if (lo is None or generator.event_start >= lo) and (hi is None or generator.event_start <= hi) \
+                and not generator.is_exception(generator.event_start):
+            yield generator.event_start, generator.event_end
+        return
+    until = hi
+    if generator.repeat_until is not None and (until is None or generator.repeat_until < until):
+        until = generator.repeat_until
+    duration = generator.event_duration
+    for d in generator.rruleset(after=lo):
+        if until is not None and d > until:
+            break
+        if lo is not None and d < lo:
+            continue
+        yield d, d + duration
+
+class MergedOccurrenceQuerySet(OccurrenceQuerySetFN):
+    """
+    A lazy, read-only stand-in for an OccurrenceQuerySet that merges the stored occurrences with the unsaved ones of
+    virtual generators (see GeneratorModel.virtual), in (start, end) order. Get one with
+    OccurrenceModel.objects.with_virtual().
+
+    It supports the OccurrenceQuerySetFN queries, filter() on start and end, filter() lookups and Q objects on other
+    fields (including lookups across foreign keys), get() (of stored occurrences), reverse(), iteration, slicing, len()
+    and an estimated count(), so it can be paginated and passed to EventViews. Slicing only expands the rules and reads
+    the rows needed to reach the end of the slice. If the start isn't bounded above, virtual occurrences are only
+    included up to each generator's horizon, since endless rules never run out.
+    """
+
+    MASK_BATCH_SIZE = 100
+
+    def __init__(self, stored, generators):
+        self._stored = stored
+        self._generators = generators.filter(virtual=True).select_related('rule', 'event')
+        self._start_bounds = [None, None]
+        self._end_bounds = [None, None]
+        self._lookups = []
+        self._reversed = False
+        self.model = stored.model
+
+    def _clone(self):
+        c = type(self).__new__(type(self))
+        c.__dict__.update(self.__dict__)
+        c._start_bounds = list(self._start_bounds)
+        c._end_bounds = list(self._end_bounds)
+        c._lookups = list(self._lookups)
+        return c
+
+    def all(self):
+        return self._clone()
+
+    def filter(self, *args, **kwargs):
+        c = self._clone()
+        c._stored = c._stored.filter(*args, **kwargs)
+        if args:
+            c._lookups.append(('Q', args))
+        for lookup, value in kwargs.items():
+            field, _, op = lookup.partition('__')
+            if field in ('start', 'end') and op in ('gte', 'gt', 'lte', 'lt', '', 'exact'):
+                _narrow(c._start_bounds if field == 'start' else c._end_bounds, op, value)
+            else:
+                c._lookups.append((lookup, value))
+        return c
+
+    def reverse(self):
+        c = self._clone()
+        c._stored = c._stored.reverse()
+        c._reversed = not c._reversed
+        return c
+
+    def get(self, *args, **kwargs):
+        return self._stored.get(*args, **kwargs)
+
+    def _virtual_generators(self):
+        """
+        The generators whose occurrences pass the non-time lookups. All the occurrences of a generator have the same
+        fields apart from start and end, so one sample decides.
+        """
+        generators = []
+        for g in self._generators:
+            sample = g.virtual_occurrence(g.event_start, g.event_end)
+            for lookup, value in self._lookups:
+                if lookup == 'Q':
+                    if not all(_matches_q(sample, q) for q in value):
+                        break
+                elif not _matches(sample, lookup, value):
+                    break
+            else:
+                generators.append(g)
+        return generators
+
+    def _candidate_spans(self, generators):
+        """
+        Lazily yields the (start, end, generator index) of the generators' dates in the window, in order. A window with
+        no upper start bound ends at each generator's horizon.
+        """
+        lo, hi = self._start_bounds
+        end_lo, end_hi = self._end_bounds
+        def until(g):
+            if hi is None:
+                return g.horizon()
+            return hi
+        streams = [((s, e, i) for s, e in _spans(g, lo, until(g))) for i, g in enumerate(generators)]
+        for s, e, i in heapq.merge(*streams):
+            if (end_lo is None or e >= end_lo) and (end_hi is None or e <= end_hi):
+                yield s, e, i
+
+    def _virtual(self):
+        """
+        Lazily yields the unsaved occurrences in order, leaving out the ones that are stored (by the generator, or for
+        its event). The stored spans are read a batch at a time.
+        """
+        generators = self._virtual_generators()
+        if not generators:
+            return
+        candidates = self._candidate_spans(generators)
+        Occurrence = self.model
+        generator_ids = [g.pk for g in generators]
+        event_ids = list(set(g.event_id for g in generators))
+        while True:
+            batch = list(islice(candidates, self.MASK_BATCH_SIZE))
+            if not batch:
+                return
+            generator_spans, event_spans = set(), set()
+            for generator_id, event_id, s, e in Occurrence._default_manager.filter(
+                    models.Q(generator__in=generator_ids) | models.Q(event__in=event_ids),
+                    start__gte=batch[0][0], start__lte=batch[-1][0],
+                    ).values_list('generator', 'event', 'start', 'end'):
+                generator_spans.add((generator_id, s, e))
+                event_spans.add((event_id, s, e))
+            for s, e, i in batch:
+                g = generators[i]
+                if (g.pk, s, e) not in generator_spans and (g.event_id, s, e) not in event_spans:
+                    yield g.virtual_occurrence(s, e)
+
+    def _merged(self, limit=None):
+        stored = self._stored
+        if limit is not None:
+            stored = stored[:limit]
+
+        if self._reversed:
+            virtual = sorted(self._virtual(), key=lambda o: (o.start, o.end), reverse=True)
+            merged = sorted(list(stored) + virtual[:limit], key=lambda o: (o.start, o.end), reverse=True)
+            for o in merged:
+                yield o
+            return
+
+        seq = count()
+        stored_stream = ((o.start, o.end, 0, seq.next(), o) for o in stored.iterator())
+        virtual_stream = ((o.start, o.end, 1, seq.next(), o) for o in self._virtual())
+        for item in heapq.merge(stored_stream, virtual_stream):
+            yield item[-1]
+
+    def __iter__(self):
+        return self._merged()
+
+    def __len__(self):
+        return len(list(self._merged()))
+
+    def __nonzero__(self):
+        for o in self._merged(limit=1):
+            return True
+        return False
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            if k.step is not None:
+                raise ValueError("Stepped slices aren't supported.")
+            start = k.start or 0
+            if k.stop is None:
+                return list(islice(self._merged(), start, None))
+            return list(islice(self._merged(limit=k.stop), start, k.stop))
+        try:
+            return list(islice(self._merged(limit=k + 1), k, k + 1))[0]
+        except IndexError:
+            raise IndexError("list index out of range")
+
+    def count(self):
+        """
+        An estimate: the number of stored occurrences, plus the number of dates the virtual generators produce (up to
+        their horizon, if the start isn't bounded), without leaving out the dates that are stored too.
+        """
+        n = self._stored.count()
+        lo, hi = self._start_bounds
+        for g in self._virtual_generators():
+            n += sum(1 for span in _spans(g, lo, hi or g.horizon()))
+        return n
+
+    def exists(self):
+        return bool(self)
+
+    def events(self):
+        event_ids = set(self._stored.values_list('event_id', flat=True).distinct())
+        lo, hi = self._start_bounds
+        for g in self._virtual_generators():
+            if g.event_id not in event_ids:
+                for span in _spans(g, lo, hi):
+                    event_ids.add(g.event_id)
+                    break
+        return self.model.Event()._event_manager.filter(id__in=event_ids)
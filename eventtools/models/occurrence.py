@@ -1,22 +1,139 @@
-from django.db import models
+from django.db import models, connections
 from django.core.exceptions import ValidationError
 from django.utils.safestring import mark_safe
 from django.core.urlresolvers import reverse
 from django.db.models import signals
 from django.db.models.base import ModelBase
+from django.db.models.sql import DeleteQuery
+from django.core.cache import cache
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.utils.datastructures import SortedDict
 
-from eventtools.utils import datetimeify, dayify
+from eventtools.utils import datetimeify, dayify, quantized_now
 from eventtools.conf import settings
 from eventtools.utils import dateranges
 from eventtools.utils.pprint_timespan import pprint_datetime_span, pprint_time_span
+from eventtools.models.event import _events_deleting
 
-from datetime import date, time, datetime
+from datetime import date, time, datetime, timedelta
 
 from dateutil import parser as dateparser
 from dateutil.relativedelta import relativedelta
+from itertools import islice
+import re
+import threading
+import time as _time
+from hashlib import md5
 
 from vobject.base import backslashEscape
 
+def _now():
+    return quantized_now(settings.NOW_QUANTUM)
+
+def _cached_now(qs):
+    """
+    Caches the results of a query made relative to _now() (see cached()), unless NOW_QUANTUM is None, in which case
+    the query never repeats.
+    """
+    if settings.NOW_QUANTUM is None:
+        return qs
+    return qs.cached()
+
+_local = threading.local()
+
+def _generators_deleting_quietly():
+    """
+    The pks of the generators whose occurrences are being deleted in this thread without adding exceptions (see
+    GeneratorModel._delete_occurrences).
+    """
+    if not hasattr(_local, 'quiet_generators'):
+        _local.quiet_generators = set()
+    return _local.quiet_generators
+
+# the first date of the period each date is in
+_PERIOD_STARTS = {
+    'day': lambda d: d,
+    'week': lambda d: dateranges.dates_for_week_of(d)[0],
+    'month': lambda d: dateranges.dates_for_month_of(d)[0],
+    'year': lambda d: dateranges.dates_for_year_of(d)[0],
+}
+
+def _period_start(period):
+    try:
+        return _PERIOD_STARTS[period]
+    except KeyError:
+        raise ValueError("period must be one of %s, not %r" % (", ".join(sorted(_PERIOD_STARTS)), period))
+
+def _as_date(value):
+    # date_trunc_sql gives datetimes on some backends, and strings on others (sqlite)
+    if isinstance(value, basestring):
+        return datetime.strptime(value[:10], '%Y-%m-%d').date()
+    if isinstance(value, datetime):
+        return value.date()
+    return value
+
+_ISO_DATETIME = re.compile(r'^(\d{4})-(\d\d)-(\d\d)(?:[T ](\d\d):(\d\d)(?::(\d\d))?)?$')
+
+def _parse_GET_date(value):
+    """
+    Parses a date(time) GET parameter. Strict ISO 8601 dates and datetimes (as in the links eventtools makes) are
+    parsed directly; anything else goes through dateutil's (much slower) fuzzy parser.
+    """
+    match = _ISO_DATETIME.match(value)
+    if match:
+        try:
+            return datetime(*[int(g) for g in match.groups() if g is not None])
+        except ValueError:
+            pass
+    return dateparser.parse(value)
+
+# from_GET's compiled queries, by the startdate and enddate GET values, so a repeated range isn't parsed again.
+# Cleared when full, since the keys come from requests.
+_compiled_GET = {}
+_COMPILED_GET_SIZE = 1000
+
+def _compile_GET(fr, to):
+    """
+    Returns (chain, (fr, to)) for startdate and enddate GET values, where chain is the list of (query function, args)
+    that from_GET applies, and fr and to are the parsed dates (or None).
+
+    The results of a date range don't depend on now, so its chain ends with cached(): if
+    settings.OCCURRENCE_CACHE_TIMEOUT is set, the first page of each range is cached until the occurrences change.
+    forthcoming() is cached only if NOW_QUANTUM is set (see _cached_now).
+    """
+    key = (fr, to)
+    compiled = _compiled_GET.get(key)
+    if compiled is None:
+        if fr is not None:
+            fr = _parse_GET_date(fr)
+        if to is not None:
+            to = _parse_GET_date(to)
+
+        if fr is None:
+            if to is None:
+                chain = [('forthcoming', ())]
+            else:
+                chain = [('before', (to,)), ('reverse', ()), ('cached', ())] #bleh, results unlikely to be authentic. First person to use this fix it up.
+        else:
+            if to is None:
+                chain = [('after', (fr,)), ('cached', ())]
+            else:
+                chain = [('between', (fr, to)), ('cached', ())]
+        compiled = (chain, (fr, to))
+
+        if len(_compiled_GET) >= _COMPILED_GET_SIZE:
+            _compiled_GET.clear()
+        _compiled_GET[key] = compiled
+    return compiled
+
+def _dates_covered(start, end):
+    """
+    The dates an occurrence from `start` to `end` is on.
+    """
+    day = start.date()
+    while day <= end.date():
+        yield day
+        day += timedelta(1)
 
 class OccurrenceQuerySetFN(object):
     """
@@ -41,28 +158,60 @@ class OccurrenceQuerySetFN(object):
         """
         returns the occurrences that start in a given date/datetime range
         if forthcoming_only == True, and now is between start and end, then 
-        only occurrences that start AFTER datetime.now() are included.
+        only occurrences that start AFTER now are included (see settings.NOW_QUANTUM),
+        and the results are cached if NOW_QUANTUM is set (see cached()).
         """
         if forthcoming_only:
-            now = datetime.now()
+            now = _now()
             if d1 <= now <= d2:
                 d1 = now
-        return self.starts_after(d1).starts_before(d2)     
+        qs = self.starts_after(d1).starts_before(d2)
+        if forthcoming_only:
+            return _cached_now(qs)
+        return qs
     def ends_between(self, d1, d2, forthcoming_only=False):
         if forthcoming_only:
-            now = datetime.now()
+            now = _now()
             if d1 <= now <= d2:
                 d1 = now
-        return self.ends_after(d1).ends_before(d2)
+        qs = self.ends_after(d1).ends_before(d2)
+        if forthcoming_only:
+            return _cached_now(qs)
+        return qs
     def entirely_between(self, d1, d2, forthcoming_only=False):
         """
         returns the occurrences that both start and end in a given datetime range
         """
         if forthcoming_only:
-            now = datetime.now()
+            now = _now()
             if d1 <= now <= d2:
                 d1 = now
-        return self.starts_after(d1).ends_before(d2)
+        qs = self.starts_after(d1).ends_before(d2)
+        if forthcoming_only:
+            return _cached_now(qs)
+        return qs
+    def overlapping(self, d1, d2, forthcoming_only=False):
+        """
+        returns the occurrences that are on at any time in a given date/datetime range, ie those that start before the
+        range ends and end after it starts.
+        if forthcoming_only == True, and now is between start and end, then
+        only occurrences that end AFTER now are included.
+
+        If settings.OCCURRENCE_MAX_DURATION is set, the start is bounded below as well, so the query is a range scan
+        of the (start, end) index instead of a scan of everything that started before d2.
+        """
+        start = datetimeify(d1, clamp="min")
+        end = datetimeify(d2, clamp="max")
+        if forthcoming_only:
+            now = _now()
+            if start <= now <= end:
+                start = now
+        qs = self.filter(start__lte=end, end__gte=start)
+        if settings.OCCURRENCE_MAX_DURATION is not None:
+            qs = qs.filter(start__gte=start - settings.OCCURRENCE_MAX_DURATION)
+        if forthcoming_only:
+            return _cached_now(qs)
+        return qs
 
     def starts_on(self, day, forthcoming_only=False):
         d1, d2 = dayify(day)
@@ -73,6 +222,9 @@ class OccurrenceQuerySetFN(object):
     def entirely_on(self, day, forthcoming_only=False):
         d1, d2 = dayify(day)
         return self.entirely_between(d1, d2, forthcoming_only)
+    def overlapping_on(self, day, forthcoming_only=False):
+        d1, d2 = dayify(day)
+        return self.overlapping(d1, d2, forthcoming_only)
     
     def starts_in_week_of(self, day, forthcoming_only=False):
         d1, d2 = dateranges.dates_for_week_of(day)
@@ -83,6 +235,9 @@ class OccurrenceQuerySetFN(object):
     def entirely_in_week_of(self, day, forthcoming_only=False):
         d1, d2 = dateranges.dates_for_week_of(day)
         return self.entirely_between(d1, d2, forthcoming_only)
+    def overlapping_in_week_of(self, day, forthcoming_only=False):
+        d1, d2 = dateranges.dates_for_week_of(day)
+        return self.overlapping(d1, d2, forthcoming_only)
 
     def starts_in_weekend_of(self, day, forthcoming_only=False):
         d1, d2 = dateranges.dates_for_weekend_of(day)
@@ -93,6 +248,9 @@ class OccurrenceQuerySetFN(object):
     def entirely_in_weekend_of(self, day, forthcoming_only=False):
         d1, d2 = dateranges.dates_for_weekend_of(day)
         return self.entirely_between(d1, d2, forthcoming_only)
+    def overlapping_in_weekend_of(self, day, forthcoming_only=False):
+        d1, d2 = dateranges.dates_for_weekend_of(day)
+        return self.overlapping(d1, d2, forthcoming_only)
 
     def starts_in_fortnight_of(self, day, forthcoming_only=False):
         d1, d2 = dateranges.dates_for_fortnight_of(day)
@@ -103,6 +261,9 @@ class OccurrenceQuerySetFN(object):
     def entirely_in_fortnight_of(self, day, forthcoming_only=False):
         d1, d2 = dateranges.dates_for_fortnight_of(day)
         return self.entirely_between(d1, d2, forthcoming_only)
+    def overlapping_in_fortnight_of(self, day, forthcoming_only=False):
+        d1, d2 = dateranges.dates_for_fortnight_of(day)
+        return self.overlapping(d1, d2, forthcoming_only)
 
     def starts_in_month_of(self, day, forthcoming_only=False):
         d1, d2 = dateranges.dates_for_month_of(day)
@@ -113,6 +274,9 @@ class OccurrenceQuerySetFN(object):
     def entirely_in_month_of(self, day, forthcoming_only=False):
         d1, d2 = dateranges.dates_for_month_of(day)
         return self.entirely_between(d1, d2, forthcoming_only)
+    def overlapping_in_month_of(self, day, forthcoming_only=False):
+        d1, d2 = dateranges.dates_for_month_of(day)
+        return self.overlapping(d1, d2, forthcoming_only)
 
     def starts_in_year_of(self, day, forthcoming_only=False):
         d1, d2 = dateranges.dates_for_year_of(day)
@@ -123,14 +287,24 @@ class OccurrenceQuerySetFN(object):
     def entirely_in_year_of(self, day, forthcoming_only=False):
         d1, d2 = dateranges.dates_for_year_of(day)
         return self.entirely_between(d1, d2, forthcoming_only)
+    def overlapping_in_year_of(self, day, forthcoming_only=False):
+        d1, d2 = dateranges.dates_for_year_of(day)
+        return self.overlapping(d1, d2, forthcoming_only)
 
     #queries relative to now
+    #(with forthcoming_only, the *_on queries are relative to _now() and already cached only if NOW_QUANTUM is set)
     def starts_today(self, forthcoming_only=False):
-        return self.starts_on(date.today(), forthcoming_only)
+        qs = self.starts_on(date.today(), forthcoming_only)
+        return qs if forthcoming_only else qs.cached()
     def ends_today(self, forthcoming_only=False):
-        return self.ends_on(date.today(), forthcoming_only)
+        qs = self.ends_on(date.today(), forthcoming_only)
+        return qs if forthcoming_only else qs.cached()
     def entirely_today(self, forthcoming_only=False):
-        return self.entirely_on(date.today(), forthcoming_only)
+        qs = self.entirely_on(date.today(), forthcoming_only)
+        return qs if forthcoming_only else qs.cached()
+    def overlapping_today(self, forthcoming_only=False):
+        qs = self.overlapping_on(date.today(), forthcoming_only)
+        return qs if forthcoming_only else qs.cached()
 
     def starts_this_week(self, forthcoming_only=False):
         return self.starts_in_week_of(date.today(), forthcoming_only)
@@ -138,6 +312,8 @@ class OccurrenceQuerySetFN(object):
         return self.ends_in_week_of(date.today(), forthcoming_only)
     def entirely_this_week(self, forthcoming_only=False):
         return self.entirely_in_week_of(date.today(), forthcoming_only)
+    def overlapping_this_week(self, forthcoming_only=False):
+        return self.overlapping_in_week_of(date.today(), forthcoming_only)
 
     def starts_this_weekend(self, forthcoming_only=False):
         return self.starts_in_weekend_of(date.today(), forthcoming_only)
@@ -145,6 +321,8 @@ class OccurrenceQuerySetFN(object):
         return self.ends_in_weekend_of(date.today(), forthcoming_only)
     def entirely_this_weekend(self, forthcoming_only=False):
         return self.entirely_in_weekend_of(date.today(), forthcoming_only)
+    def overlapping_this_weekend(self, forthcoming_only=False):
+        return self.overlapping_in_weekend_of(date.today(), forthcoming_only)
 
     def starts_this_fortnight(self, forthcoming_only=False):
         return self.starts_in_fortnight_of(date.today(), forthcoming_only)
@@ -152,6 +330,8 @@ class OccurrenceQuerySetFN(object):
         return self.ends_in_fortnight_of(date.today(), forthcoming_only)
     def entirely_this_week(self, forthcoming_only=False):
         return self.entirely_in_fortnight_of(date.today(), forthcoming_only)
+    def overlapping_this_fortnight(self, forthcoming_only=False):
+        return self.overlapping_in_fortnight_of(date.today(), forthcoming_only)
 
     def starts_this_month(self, forthcoming_only=False):
         return self.starts_in_month_of(date.today(), forthcoming_only)
@@ -159,6 +339,8 @@ class OccurrenceQuerySetFN(object):
         return self.ends_in_month_of(date.today(), forthcoming_only)
     def entirely_this_month(self, forthcoming_only=False):
         return self.entirely_in_month_of(date.today(), forthcoming_only)
+    def overlapping_this_month(self, forthcoming_only=False):
+        return self.overlapping_in_month_of(date.today(), forthcoming_only)
 
     def starts_this_year(self, forthcoming_only=False):
         return self.starts_in_year_of(date.today(), forthcoming_only)
@@ -166,6 +348,8 @@ class OccurrenceQuerySetFN(object):
         return self.ends_in_year_of(date.today(), forthcoming_only)
     def entirely_this_year(self, forthcoming_only=False):
         return self.entirely_in_year_of(date.today(), forthcoming_only)
+    def overlapping_this_year(self, forthcoming_only=False):
+        return self.overlapping_in_year_of(date.today(), forthcoming_only)
 
 
 
@@ -175,6 +359,8 @@ class OccurrenceQuerySetFN(object):
         return self.ends_on(date.today()-timedelta(1))
     def entirely_yesterday(self):
         return self.entirely_on(date.today()-timedelta(1))
+    def overlapping_yesterday(self):
+        return self.overlapping_on(date.today()-timedelta(1))
 
     def starts_last_week(self):
         return self.starts_in_week_of(date.today()-timedelta(7))
@@ -182,6 +368,8 @@ class OccurrenceQuerySetFN(object):
         return self.ends_in_week_of(date.today()-timedelta(7))
     def entirely_last_week(self):
         return self.entirely_in_week_of(date.today()-timedelta(7))
+    def overlapping_last_week(self):
+        return self.overlapping_in_week_of(date.today()-timedelta(7))
 
     def starts_last_weekend(self):
         return self.starts_in_weekend_of(date.today()-timedelta(7))
@@ -189,6 +377,8 @@ class OccurrenceQuerySetFN(object):
         return self.ends_in_weekend_of(date.today()-timedelta(7))
     def entirely_last_weekend(self):
         return self.entirely_in_weekend_of(date.today()-timedelta(7))
+    def overlapping_last_weekend(self):
+        return self.overlapping_in_weekend_of(date.today()-timedelta(7))
 
     def starts_last_fortnight(self):
         return self.starts_in_fortnight_of(date.today()-timedelta(14))
@@ -196,6 +386,8 @@ class OccurrenceQuerySetFN(object):
         return self.ends_in_fortnight_of(date.today()-timedelta(14))
     def entirely_last_week(self):
         return self.entirely_in_fortnight_of(date.today()-timedelta(14))
+    def overlapping_last_fortnight(self):
+        return self.overlapping_in_fortnight_of(date.today()-timedelta(14))
 
     def starts_last_month(self):
         return self.starts_in_month_of(date.today()+relativedelta(months=-1))
@@ -203,6 +395,8 @@ class OccurrenceQuerySetFN(object):
         return self.ends_in_month_of(date.today()+relativedelta(months=-1))
     def entirely_last_month(self):
         return self.entirely_in_month_of(date.today()+relativedelta(months=-1))
+    def overlapping_last_month(self):
+        return self.overlapping_in_month_of(date.today()+relativedelta(months=-1))
 
     def starts_last_year(self):
         return self.starts_in_year_of(date.today()+relativedelta(years=-1))
@@ -210,6 +404,8 @@ class OccurrenceQuerySetFN(object):
         return self.ends_in_year_of(date.today()+relativedelta(years=-1))
     def entirely_last_year(self):
         return self.entirely_in_year_of(date.today()+relativedelta(years=-1))
+    def overlapping_last_year(self):
+        return self.overlapping_in_year_of(date.today()+relativedelta(years=-1))
 
 
 
@@ -219,6 +415,8 @@ class OccurrenceQuerySetFN(object):
         return self.ends_on(date.today()+timedelta(1))
     def entirely_tomorrow(self):
         return self.entirely_on(date.today()+timedelta(1))
+    def overlapping_tomorrow(self):
+        return self.overlapping_on(date.today()+timedelta(1))
 
     def starts_next_week(self):
         return self.starts_in_week_of(date.today()+timedelta(7))
@@ -226,6 +424,8 @@ class OccurrenceQuerySetFN(object):
         return self.ends_in_week_of(date.today()+timedelta(7))
     def entirely_next_week(self):
         return self.entirely_in_week_of(date.today()+timedelta(7))
+    def overlapping_next_week(self):
+        return self.overlapping_in_week_of(date.today()+timedelta(7))
 
     def starts_next_weekend(self):
         return self.starts_in_weekend_of(date.today()+timedelta(7))
@@ -233,6 +433,8 @@ class OccurrenceQuerySetFN(object):
         return self.ends_in_weekend_of(date.today()+timedelta(7))
     def entirely_next_weekend(self):
         return self.entirely_in_weekend_of(date.today()+timedelta(7))
+    def overlapping_next_weekend(self):
+        return self.overlapping_in_weekend_of(date.today()+timedelta(7))
 
     def starts_next_fortnight(self):
         return self.starts_in_fortnight_of(date.today()+timedelta(14))
@@ -240,6 +442,8 @@ class OccurrenceQuerySetFN(object):
         return self.ends_in_fortnight_of(date.today()+timedelta(14))
     def entirely_next_week(self):
         return self.entirely_in_fortnight_of(date.today()+timedelta(14))
+    def overlapping_next_fortnight(self):
+        return self.overlapping_in_fortnight_of(date.today()+timedelta(14))
 
     def starts_next_month(self):
         return self.starts_in_month_of(date.today()+relativedelta(months=1))
@@ -247,6 +451,8 @@ class OccurrenceQuerySetFN(object):
         return self.ends_in_month_of(date.today()+relativedelta(months=1))
     def entirely_next_month(self):
         return self.entirely_in_month_of(date.today()+relativedelta(months=1))
+    def overlapping_next_month(self):
+        return self.overlapping_in_month_of(date.today()+relativedelta(months=1))
 
     def starts_next_year(self):
         return self.starts_in_year_of(date.today()+relativedelta(years=+1))
@@ -254,6 +460,8 @@ class OccurrenceQuerySetFN(object):
         return self.ends_in_year_of(date.today()+relativedelta(years=+1))
     def entirely_next_year(self):
         return self.entirely_in_year_of(date.today()+relativedelta(years=+1))
+    def overlapping_next_year(self):
+        return self.overlapping_in_year_of(date.today()+relativedelta(years=+1))
 
     #defaults
     before = starts_before
@@ -286,15 +494,22 @@ class OccurrenceQuerySetFN(object):
     next_year = starts_next_year
 
     #misc queries (note they assume starts_ and ends_)
+    #if settings.NOW_QUANTUM is set, "now" is rounded down to it, so that these repeat the same query, and their results are cached.
     def forthcoming(self):
-        return self.starts_after(datetime.now())
+        return _cached_now(self.starts_after(_now()))
 
     def recent(self):
-        return self.ends_before(datetime.now())
+        return _cached_now(self.ends_before(_now()))
         
     def now_on(self):
-        n = datetime.now()
-        return self.starts_before(n).ends_after(n)
+        n = _now()
+        return _cached_now(self.overlapping(n, n))
+
+    def cached(self):
+        """
+        Returns these occurrences, with their results cached if that's supported (see OccurrenceQuerySet.cached).
+        """
+        return self
         
     def events(self):
         """
@@ -302,34 +517,201 @@ class OccurrenceQuerySetFN(object):
         """
         event_ids = self.values_list('event_id', flat=True).distinct()
         return self.model.Event()._event_manager.filter(id__in=event_ids)
+
+    def days_between(self, d1, d2):
+        """
+        Returns a list of (date, occurrence) pairs, in date order, for each date from d1 to d2 that each occurrence is
+        on. Occurrences that span several days appear once for each of them.
+        """
+        first = dayify(d1)[0].date()
+        last = dayify(d2)[0].date()
+        occurrences = self.overlapping(first, last)
+        if hasattr(occurrences, 'iterator'):
+            occurrences = occurrences.iterator()
+        pairs = []
+        for occ in occurrences:
+            for day in _dates_covered(occ.start, occ.end):
+                if first <= day <= last:
+                    pairs.append((day, occ))
+        pairs.sort(key=lambda pair: pair[0])
+        return pairs
+
+    def group_by_period(self, period, d1, d2):
+        """
+        Returns a SortedDict that maps the first date of each 'day', 'week' (see settings.FIRST_DAY_OF_WEEK), 'month' or
+        'year' from d1 to d2 that has occurrences to a list of them, in order. The window is fetched in one query, and
+        occurrences that span several periods are listed in each of them.
+        """
+        period_start = _period_start(period)
+        groups = SortedDict()
+        seen = set()
+        for day, occ in self.days_between(d1, d2):
+            key = period_start(day)
+            if (key, occ.pk or id(occ)) not in seen: #virtual occurrences have no pk
+                seen.add((key, occ.pk or id(occ)))
+                groups.setdefault(key, []).append(occ)
+        return groups
+
+    def group_by_day(self, d1, d2):
+        return self.group_by_period('day', d1, d2)
+    def group_by_week(self, d1, d2):
+        return self.group_by_period('week', d1, d2)
+    def group_by_month(self, d1, d2):
+        return self.group_by_period('month', d1, d2)
+    def group_by_year(self, d1, d2):
+        return self.group_by_period('year', d1, d2)
+
+    def counts_by_period(self, period, d1, d2):
+        """
+        Returns a list of (first date, number of occurrences) pairs, in order, for each 'day', 'week' (see
+        settings.FIRST_DAY_OF_WEEK), 'month' or 'year' from d1 to d2 in which occurrences start. Periods without
+        occurrences are left out.
+        """
+        period_start = _period_start(period)
+        counts = SortedDict()
+        for occ in self.starts_between(d1, d2):
+            key = period_start(occ.start.date())
+            counts[key] = counts.get(key, 0) + 1
+        return counts.items()
         
     def from_GET(self, GET={}):
+        """
+        Returns (occurrences, (from, to)) for a GET dictionary with 'startdate' and/or 'enddate' (see
+        settings.EVENT_GET_MAP). The query for each range is memoized by the GET values, and the results of a date
+        range are cached (see _compile_GET).
+        """
         mapped_GET = {}
         for k, v in GET.iteritems():
             mapped_GET[settings.EVENT_GET_MAP.get(k, k)] = v
-        
-        fr = mapped_GET.get('startdate', None)
-        to = mapped_GET.get('enddate', None)
-        
-        if fr is not None:
-            fr = dateparser.parse(fr)
-        if to is not None:
-            to = dateparser.parse(to)
 
-        if fr is None:
-            if to is None:
-                return self.forthcoming(), (fr, to)
-            else:
-                return self.before(to).reverse(), (fr, to) #bleh, results unlikely to be authentic. First person to use this fix it up.
-        else:
-            if to is None:
-                return self.after(fr), (fr, to)
-            else:
-                return self.between(fr, to), (fr, to)
+        chain, bounds = _compile_GET(mapped_GET.get('startdate', None), mapped_GET.get('enddate', None))
+        qs = self
+        for fname, args in chain:
+            qs = getattr(qs, fname)(*args)
+        return qs, bounds
                 
         
 class OccurrenceQuerySet(models.query.QuerySet, OccurrenceQuerySetFN):
-    pass #all the goodness is inherited from OccurrenceQuerySetFN
+    #all the goodness is inherited from OccurrenceQuerySetFN
+
+    def __init__(self, *args, **kwargs):
+        super(OccurrenceQuerySet, self).__init__(*args, **kwargs)
+        self._cache_results = False
+
+    def _clone(self, *args, **kwargs):
+        c = super(OccurrenceQuerySet, self)._clone(*args, **kwargs)
+        c._cache_results = self._cache_results
+        return c
+
+    def cached(self):
+        """
+        Returns a copy of this queryset whose results are cached for settings.OCCURRENCE_CACHE_TIMEOUT seconds, keyed
+        on its SQL. Saving, generating or deleting occurrences of the model invalidates the cache (so does calling
+        invalidate_query_cache() on the model, eg after a QuerySet.update()).
+        """
+        c = self._clone()
+        c._cache_results = True
+        return c
+
+    def iterator(self):
+        timeout = settings.OCCURRENCE_CACHE_TIMEOUT
+        if not self._cache_results or timeout is None:
+            return super(OccurrenceQuerySet, self).iterator()
+        try:
+            sql, params = self.query.get_compiler(using=self.db).as_sql()
+        except EmptyResultSet:
+            return super(OccurrenceQuerySet, self).iterator()
+        key = 'eventtools:results:%s' % md5(
+            repr((self.db, self.model._query_cache_generation(), sql, params))).hexdigest()
+        results = cache.get(key)
+        if results is None:
+            results = list(super(OccurrenceQuerySet, self).iterator())
+            cache.set(key, results, timeout)
+        return iter(results)
+
+    def delete(self):
+        """
+        Deletes these occurrences, and recalculates the stored span of their events (see EventMeta.occurrence_span)
+        once per event rather than once per occurrence.
+        """
+        Event = self.model.Event()
+        if not getattr(Event._event_meta, 'occurrence_span', False) or \
+                getattr(_local, 'deferred_span_events', None) is not None:
+            return super(OccurrenceQuerySet, self).delete()
+        _local.deferred_span_events = event_ids = set()
+        try:
+            super(OccurrenceQuerySet, self).delete()
+        finally:
+            _local.deferred_span_events = None
+        Event.update_occurrence_spans(event_ids)
+    delete.alters_data = True
+
+    def with_virtual(self, generators=None):
+        """
+        Returns a MergedOccurrenceQuerySet of these occurrences and the unsaved occurrences of the given virtual
+        generators (by default, all of them).
+        """
+        from eventtools.models.merged import MergedOccurrenceQuerySet
+        if generators is None:
+            generators = self.model._meta.get_field('generator').rel.to._default_manager.all()
+        return MergedOccurrenceQuerySet(self, generators)
+
+    # If the model has day buckets (see OccurrenceOptions), these are equality joins on the bucket date.
+    def overlapping_on(self, day, forthcoming_only=False):
+        if self.model._occurrence_meta.day_model is None:
+            return super(OccurrenceQuerySet, self).overlapping_on(day, forthcoming_only)
+        d1, d2 = dayify(day)
+        qs = self.filter(days__date=d1.date())
+        if forthcoming_only:
+            now = _now()
+            if d1 <= now <= d2:
+                qs = qs.filter(end__gte=now)
+        return qs
+
+    def days_between(self, d1, d2):
+        Day = self.model._occurrence_meta.day_model
+        if Day is None:
+            return super(OccurrenceQuerySet, self.select_related('event')).days_between(d1, d2)
+        days = Day._default_manager.filter(
+            date__gte=dayify(d1)[0].date(),
+            date__lte=dayify(d2)[0].date(),
+            occurrence__in=self,
+        ).select_related('occurrence__event').order_by('date', 'occurrence__start', 'occurrence__end')
+        return [(d.date, d.occurrence) for d in days.iterator()]
+
+    def counts_by_period(self, period, d1, d2):
+        """
+        The occurrences are counted by the database, by day (then added up into weeks) or month or year of their start,
+        so no occurrences are loaded.
+        """
+        period_start = _period_start(period)
+        connection = connections[self.db]
+        column = '%s.%s' % (connection.ops.quote_name(self.model._meta.db_table),
+            connection.ops.quote_name(self.model._meta.get_field('start').column))
+        trunc = connection.ops.date_trunc_sql('day' if period == 'week' else period, column)
+        rows = self.starts_between(d1, d2).order_by().extra(select={'period': trunc}).values_list('period') \
+            .annotate(count=models.Count('pk')).order_by('period')
+
+        counts = SortedDict()
+        for value, count in rows:
+            key = period_start(_as_date(value))
+            counts[key] = counts.get(key, 0) + count
+        return counts.items()
+
+    def update_days(self):
+        """
+        Rebuilds the day buckets of these occurrences, eg after changing their start or end with update(), or after
+        turning day_buckets on. Returns the number of day rows written.
+        """
+        if self.model._occurrence_meta.day_model is None:
+            return 0
+        rows = self.order_by().values_list('pk', 'start', 'end').iterator()
+        count = 0
+        while True:
+            spans = list(islice(rows, settings.GENERATOR_BATCH_SIZE))
+            if not spans:
+                return count
+            count += self.model._update_days(spans)
 
 class OccurrenceManagerType(type):
     """
@@ -353,13 +735,66 @@ class OccurrenceManager(models.Manager):
     def get_query_set(self): 
         return OccurrenceQuerySet(self.model)
 
+    def with_virtual(self, *args, **kwargs):
+        return self.get_query_set().with_virtual(*args, **kwargs)
+
+def occurrence_models():
+    """
+    Returns the installed (concrete) subclasses of OccurrenceModel.
+    """
+    return [m for m in models.get_models() if issubclass(m, OccurrenceModel)]
+
+class OccurrenceOptions(object):
+    """
+    Options class for Occurrence models. Use this as an inner class called OccurrenceMeta:
+
+    class MyOccurrence(OccurrenceModel):
+        class OccurrenceMeta:
+            day_buckets = True
+        ...
+
+    day_buckets adds a table with a row for each date each occurrence is on (MyOccurrenceDay, related_name 'days'),
+    which is kept up to date when occurrences are saved, generated, timeshifted or deleted. Queries for what's on on
+    a given day (overlapping_on, days_between, the month_calendar tag) then join on its indexed date, instead of
+    scanning the occurrences that started before the day.
+    """
+
+    day_buckets = False
+    day_model = None
+
+    def __init__(self, opts):
+        # Override defaults with options provided
+        if opts:
+            for key, value in opts.__dict__.iteritems():
+                setattr(self, key, value)
+
+def _day_model(cls):
+    """
+    Creates the day bucket model for the occurrence model `cls`.
+    """
+    meta = type('Meta', (), {
+        'app_label': cls._meta.app_label,
+        'unique_together': [('date', 'occurrence')],
+    })
+    return type('%sDay' % cls.__name__, (models.Model,), {
+        '__module__': cls.__module__,
+        'Meta': meta,
+        'occurrence': models.ForeignKey(cls, related_name='days'),
+        'date': models.DateField(),
+    })
+
 class OccurrenceModelBase(ModelBase):
 
     def __new__(meta, class_name, bases, class_dict):
         """
         Create subclasses of GeneratorModel. This:
          - registers signals for when related occurrences are saved or deleted.
+         - creates the day bucket model, if OccurrenceMeta.day_buckets is set.
+         - indexes (generator, start, end), if there is a generator field.
+         - registers signals that keep the event's occurrence span up to date (see EventMeta.occurrence_span).
         """
+        occurrence_opts = class_dict.pop('OccurrenceMeta', None)
+        class_dict['_occurrence_meta'] = OccurrenceOptions(occurrence_opts)
         cls = super(OccurrenceModelBase, meta).__new__(meta, class_name, bases, class_dict)
                 
         try:
@@ -371,10 +806,19 @@ class OccurrenceModelBase(ModelBase):
             # copies)
             pass
         else:
-            # Set up signal receivers
-            pass
+            # Add the day bucket model
+            if cls._occurrence_meta.day_buckets and not cls._meta.abstract:
+                cls._occurrence_meta.day_model = _day_model(cls)
+
+            # Index the generator's duplicate checks
+            if not cls._meta.abstract and 'generator' in [f.name for f in cls._meta.fields]:
+                cls._composite_indexes = tuple(cls._composite_indexes) + (('generator', 'start', 'end'),)
             
         signals.pre_delete.connect(cls._pre_delete, sender=cls)
+        signals.post_save.connect(cls._invalidate_query_cache, sender=cls)
+        signals.post_delete.connect(cls._invalidate_query_cache, sender=cls)
+        signals.post_save.connect(cls._update_event_span, sender=cls)
+        signals.post_delete.connect(cls._update_event_span, sender=cls)
         return cls
 
 class OccurrenceModel(models.Model):
@@ -390,17 +834,30 @@ class OccurrenceModel(models.Model):
     end = models.DateTimeField(blank=True, db_index=True)
         
     objects = OccurrenceManager()
+
+    # created on syncdb, see indexes.composite_index_sql
+    _composite_indexes = (
+        ('start', 'end'), # overlapping() range-scans this, see settings.OCCURRENCE_MAX_DURATION
+        ('event', 'start', 'end'), # an event's occurrences, in order
+    )
     
     class Meta:
         abstract = True
         ordering = ('start', 'end',)
 
+    def __init__(self, *args, **kwargs):
+        super(OccurrenceModel, self).__init__(*args, **kwargs)
+        # if i'm moved to another event, the span of the one i was loaded with needs recalculating too.
+        self._loaded_event_id = self.__dict__.get('event_id') # not a deferred field's descriptor
+
     def clean(self):
         if self.end is None:
             self.end = self.start
         
         if self.start > self.end:
             raise ValidationError('start must be earlier than end')
+        if settings.OCCURRENCE_MAX_DURATION is not None and self.end - self.start > settings.OCCURRENCE_MAX_DURATION:
+            raise ValidationError('occurrences must not last longer than %s' % settings.OCCURRENCE_MAX_DURATION)
         super(OccurrenceModel, self).clean()
 
     def save(self, *args, **kwargs):
@@ -414,7 +871,17 @@ class OccurrenceModel(models.Model):
 
         if self.start > self.end:
             raise AttributeError('start must be earlier than end')
+
+        if settings.OCCURRENCE_MAX_DURATION is not None and self.duration > settings.OCCURRENCE_MAX_DURATION:
+            raise AttributeError('occurrences must not last longer than %s' % settings.OCCURRENCE_MAX_DURATION)
         
+        #if a virtual occurrence's time has been changed before it is first saved, add the generated time to the generator's exceptions.
+        generated_span = getattr(self, '_generated_span', None)
+        if generated_span is not None and not self.pk:
+            if getattr(self, 'generator', None) and generated_span != (self.start, self.end):
+                self.generator.add_exception(generated_span[0])
+            self._generated_span = None
+
         #if my time is being changed, or if i'm being detatched from the generator, add the old time to the generator's exceptions.
         #TODO: add the new time if self.start is in exceptions and durations are equal
         if getattr(self, 'generator', None) and self.pk:
@@ -427,12 +894,83 @@ class OccurrenceModel(models.Model):
                     self.generator.remove_exception(self.start)
 
         super(OccurrenceModel, self).save(*args, **kwargs)
+        type(self)._update_days([(self.pk, self.start, self.end)])
+
+    @classmethod
+    def _update_days(cls, spans):
+        """
+        Replaces the day buckets of the occurrences in `spans`, a list of (pk, start, end), with one DELETE and a few
+        INSERTs. Returns the number of day rows written.
+        """
+        Day = cls._occurrence_meta.day_model
+        if Day is None or not spans:
+            return 0
+        using = Day._default_manager.db
+        DeleteQuery(Day).delete_batch([pk for pk, start, end in spans], using, field=Day._meta.get_field('occurrence'))
+        days = [Day(occurrence_id=pk, date=day) for pk, start, end in spans for day in _dates_covered(start, end)]
+        batch_size = settings.GENERATOR_BATCH_SIZE
+        for i in range(0, len(days), batch_size):
+            Day._default_manager.bulk_create(days[i:i+batch_size])
+        return len(days)
 
     @staticmethod #connected in the metaclass
     def _pre_delete(sender, **kwargs):
         occ = kwargs['instance']
+        if getattr(occ, 'generator_id', None) in _generators_deleting_quietly():
+            return
         if hasattr(occ, 'generator') and occ.generator is not None:
             occ.generator.add_exception(occ.start)
+
+    @staticmethod #connected in the metaclass
+    def _invalidate_query_cache(sender, **kwargs):
+        sender.invalidate_query_cache()
+
+    @staticmethod #connected in the metaclass
+    def _update_event_span(sender, **kwargs):
+        occ = kwargs['instance']
+        Event = sender.Event()
+        if not getattr(Event._event_meta, 'occurrence_span', False):
+            return
+        if (Event, occ.event_id) in _events_deleting():
+            return # the event is going too
+        deferred = getattr(_local, 'deferred_span_events', None)
+        if deferred is not None and kwargs.get('signal') is signals.post_delete:
+            deferred.add(occ.event_id) # see OccurrenceQuerySet.delete
+        elif kwargs.get('created'):
+            Event.extend_occurrence_span(occ.event_id, occ.start, occ.start, occ.end)
+        else:
+            Event.update_occurrence_spans(set([occ.event_id, occ._loaded_event_id]) - set([None]))
+        occ._loaded_event_id = occ.event_id
+
+    @classmethod
+    def _query_cache_key(cls):
+        return 'eventtools:generation:%s.%s' % (cls._meta.app_label, cls._meta.object_name)
+
+    @classmethod
+    def _query_cache_generation(cls):
+        """
+        The number that cached query results are keyed on, which changes whenever the occurrences do. It starts from
+        the time, so that if it is evicted from the cache, old results aren't used again.
+        """
+        key = cls._query_cache_key()
+        generation = cache.get(key)
+        if generation is None:
+            generation = int(_time.time() * 1000)
+            cache.set(key, generation)
+        return generation
+
+    @classmethod
+    def invalidate_query_cache(cls):
+        """
+        Makes the cached query results of this model stale (see OccurrenceQuerySet.cached). This is done when
+        occurrences are saved, generated or deleted; call it after changing occurrences in other ways.
+        """
+        if settings.OCCURRENCE_CACHE_TIMEOUT is None:
+            return
+        try:
+            cache.incr(cls._query_cache_key())
+        except ValueError:
+            cache.set(cls._query_cache_key(), int(_time.time() * 1000))
        
     def __unicode__(self):
         return "%s: %s" % (self.event, self.timespan_description())
@@ -523,6 +1061,8 @@ class OccurrenceModel(models.Model):
 
         
     def get_absolute_url(self):
+        if self.id is None: #a virtual occurrence
+            return self.event.get_absolute_url()
         return reverse('occurrence', kwargs={'occurrence_id': self.id })
 
     def _resolve_attr(self, attr):
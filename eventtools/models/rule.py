@@ -1,6 +1,7 @@
 from django.db import models
 from django.utils.translation import ugettext, ugettext_lazy as _
 from dateutil import rrule
+from datetime import datetime, time, timedelta
 
 freqs = (
     ("YEARLY", _("Yearly")),
@@ -10,6 +11,122 @@ freqs = (
     ("HOURLY", _("Hourly")),
 )
 
+# Compiled rules, keyed by rule id. Each entry is a (version, compiled) pair - see Rule.get_rrule.
+_compiled_rules = {}
+
+def _with_dtstart(rule, dtstart):
+    """
+    Returns a copy of an rrule that starts at dtstart, without parsing anything again. This is rrule.replace() in
+    newer versions of dateutil. Raises AttributeError if the installed dateutil can't do it.
+    """
+    if hasattr(rule, 'replace'):
+        return rule.replace(dtstart=dtstart)
+    kwargs = {
+        'interval': rule._interval,
+        'count': rule._count,
+        'until': rule._until,
+        'wkst': rule._wkst,
+        'cache': rule._cache is not None,
+    }
+    kwargs.update(rule._original_rule)
+    return rrule.rrule(rule._freq, dtstart=dtstart, **kwargs)
+
+def _rruleset_from(template, dtstart):
+    """
+    Returns a new rruleset like `template` (as parsed by rrulestr), with its rules starting at dtstart.
+    """
+    rs = rrule.rruleset()
+    for r in template._rrule:
+        rs.rrule(_with_dtstart(r, dtstart))
+    for r in template._exrule:
+        rs.exrule(_with_dtstart(r, dtstart))
+    for d in template._rdate:
+        rs.rdate(d)
+    for d in template._exdate:
+        rs.exdate(d)
+    return rs
+
+_UNITS = {
+    rrule.DAILY: timedelta(days=1),
+    rrule.HOURLY: timedelta(hours=1),
+    rrule.MINUTELY: timedelta(minutes=1),
+    rrule.SECONDLY: timedelta(seconds=1),
+}
+
+def _period_start(r, after):
+    """
+    The start of the last period of rrule `r` (year, month, week, day...) that is a whole number of intervals after
+    the period of its dtstart and doesn't start after `after`; or None if that is dtstart's own period.
+    """
+    ds, n, freq = r._dtstart, r._interval, r._freq
+    if freq == rrule.YEARLY:
+        k = (after.year - ds.year) // n * n
+        return datetime(ds.year + k, 1, 1) if k > 0 else None
+    if freq == rrule.MONTHLY:
+        k = ((after.year - ds.year) * 12 + after.month - ds.month) // n * n
+        if k <= 0:
+            return None
+        years, month = divmod(ds.month - 1 + k, 12)
+        return datetime(ds.year + years, month + 1, 1)
+    if freq == rrule.WEEKLY:
+        first = datetime.combine(ds.date(), time.min) - timedelta((ds.weekday() - r._wkst) % 7)
+        k = (after - first).days // 7 // n * n
+        return first + timedelta(weeks=k) if k > 0 else None
+    unit = _UNITS[freq]
+    if freq == rrule.DAILY:
+        first = datetime.combine(ds.date(), time.min)
+    elif freq == rrule.HOURLY:
+        first = ds.replace(minute=0, second=0)
+    elif freq == rrule.MINUTELY:
+        first = ds.replace(second=0)
+    else:
+        first = ds
+    delta = after - first
+    k = int((delta.days * 86400 + delta.seconds) // (unit.days * 86400 + unit.seconds)) // n * n
+    return first + unit * k if k > 0 else None
+
+def _seeked(r, after):
+    """
+    Returns an rrule that produces the same dates as `r` from `after` on, but starts from the period around `after`
+    rather than from r's dtstart: its by* values (including the ones r took from dtstart) are pinned, and dtstart moves
+    to the start of that period. Returns None for rules with a count, which must be counted from dtstart.
+    """
+    if r._count is not None:
+        return None
+    dtstart = _period_start(r, after)
+    if dtstart is None:
+        return r
+    byweekday = list(r._byweekday or ()) + [rrule.weekday(wd, n) for wd, n in (r._bynweekday or ())]
+    bymonthday = list(r._bymonthday or ()) + list(r._bynmonthday or ())
+    return rrule.rrule(r._freq, dtstart=dtstart, interval=r._interval, until=r._until, wkst=r._wkst,
+        bysetpos=r._bysetpos, bymonth=r._bymonth, bymonthday=bymonthday or None, byyearday=r._byyearday,
+        byeaster=r._byeaster, byweekno=r._byweekno, byweekday=byweekday or None, byhour=r._byhour,
+        byminute=r._byminute, bysecond=r._bysecond, cache=r._cache is not None)
+
+def rruleset_after(rs, after):
+    """
+    Returns an rruleset that produces the same dates as `rs` from `after` on, without expanding its rules from their
+    dtstart up to `after`. Dates before `after` may still be produced, so callers filter them. If `rs` can't be
+    moved (eg a rule has a count), it is returned as it is.
+    """
+    try:
+        rrules = [_seeked(r, after) for r in rs._rrule]
+        exrules = [_seeked(r, after) for r in rs._exrule]
+    except AttributeError:
+        return rs
+    if None in rrules or None in exrules:
+        return rs
+    seeked = rrule.rruleset()
+    for r in rrules:
+        seeked.rrule(r)
+    for r in exrules:
+        seeked.exrule(r)
+    for d in rs._rdate:
+        seeked.rdate(d)
+    for d in rs._exdate:
+        seeked.exdate(d)
+    return seeked
+
 class Rule(models.Model):
     """
     This defines a rule by which an occurrence will repeat.  This is defined by the
@@ -74,15 +191,65 @@ class Rule(models.Model):
         """Human readable string for Rule"""
         return self.name or unicode(self.frequency).lower()
 
-    def get_rrule(self, dtstart):
+    def save(self, *args, **kwargs):
+        super(Rule, self).save(*args, **kwargs)
+        _compiled_rules.pop(self.pk, None)
+
+    def delete(self, *args, **kwargs):
+        _compiled_rules.pop(self.pk, None)
+        super(Rule, self).delete(*args, **kwargs)
+
+    def version(self):
+        """
+        A stamp that changes whenever the rule's definition does, so instances loaded before a change don't share
+        compiled rules with instances loaded after it.
+        """
+        return (self.frequency, self.params, self.complex_rule)
+
+    def compile_rrule(self):
+        """
+        Returns a function that takes a dtstart and returns this rule's rruleset starting then. All the parsing and
+        validation of the rule is done here, once: complex rules are parsed into a template, which is copied with
+        each dtstart (unless the rule sets its own DTSTART, or dateutil can't copy rules, when the string is parsed on
+        each call).
+
+        If the complex rule can't be parsed, the simple rule is used instead.
+        """
         if self.complex_rule:
             try:
-                return rrule.rrulestr(str(self.complex_rule), dtstart=dtstart)
-            except: #Except what?
+                complex_rule = str(self.complex_rule)
+                template = rrule.rrulestr(complex_rule, dtstart=datetime.now(), forceset=True)
+            except Exception: #unparseable (or not ascii): use the simple rule
                 pass
+            else:
+                reparse = lambda dtstart: rrule.rrulestr(complex_rule, dtstart=dtstart, forceset=True)
+                if 'DTSTART' in complex_rule.upper():
+                    return reparse
+                try:
+                    _rruleset_from(template, datetime.now())
+                except AttributeError: #dateutil is too old to copy rules
+                    return reparse
+                return lambda dtstart: _rruleset_from(template, dtstart)
+
+        frequency = getattr(rrule, self.frequency)
         params = self.get_params()
-        frequency = 'rrule.%s' % self.frequency
-        simple_rule = rrule.rrule(eval(frequency), dtstart=dtstart, **params)
-        rs = rrule.rruleset()
-        rs.rrule(simple_rule)
-        return rs
+        def compiled(dtstart):
+            rs = rrule.rruleset()
+            rs.rrule(rrule.rrule(frequency, dtstart=dtstart, **params))
+            return rs
+        return compiled
+
+    def get_rrule(self, dtstart):
+        """
+        Common rules are shared by lots of generators, so compiled rules are cached for the life of the process, and
+        only dtstart is applied on each call. Saving or deleting the rule drops its entry from the cache.
+        """
+        if self.pk is None:
+            return self.compile_rrule()(dtstart)
+
+        version = self.version()
+        cached = _compiled_rules.get(self.pk)
+        if cached is None or cached[0] != version:
+            cached = (version, self.compile_rrule())
+            _compiled_rules[self.pk] = cached
+        return cached[1](dtstart)
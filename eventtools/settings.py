@@ -19,4 +19,10 @@ ICAL_CALNAME = getattr(settings, 'SITE_NAME', 'Events list')
 ICAL_CALDESC = "Events listing" #e.g. "Events listing from mysite.com"
 
 from dateutil.relativedelta import relativedelta
-DEFAULT_GENERATOR_LIMIT = relativedelta(years=1) #months=6, etc
\ No newline at end of file
+DEFAULT_GENERATOR_LIMIT = relativedelta(years=1) #months=6, etc
+GENERATOR_BATCH_SIZE = 500 #occurrences per INSERT when generating
+GENERATOR_DIFF_ON_CHANGE = False #delete untouched occurrences a generator no longer produces when its rule/repeat_until changes
+OCCURRENCE_MAX_DURATION = None #eg timedelta(days=1). If set, overlapping() queries become range scans of the (start, end) index, and longer occurrences can't be saved.
+from datetime import timedelta
+NOW_QUANTUM = None #eg timedelta(minutes=1). If set, "now" in forthcoming(), now_on() etc is rounded down to it, so the queries repeat and can be cached. None uses the exact time.
+OCCURRENCE_CACHE_TIMEOUT = None #seconds to cache the results of "now"-relative queries (and .cached() ones) for, eg 60. None turns the cache off.
@@ -10,7 +10,7 @@ from eventtools.models import EventModel
 
 register = template.Library()
 
-def month_calendar(context, events_pool=[], month=None, show_header=True, selected_start=None, selected_end=None, week_start=None, strip_empty_weeks=None):
+def month_calendar(context, events_pool=[], month=None, show_header=True, selected_start=None, selected_end=None, week_start=None, strip_empty_weeks=None, occurrence_pool=None):
     """
     Creates a configurable html calendar displaying one month
     
@@ -22,6 +22,7 @@ def month_calendar(context, events_pool=[], month=None, show_header=True, select
     selected_end:
     week_start:
     strip_empty_weeks: None, 'leading', 'trailing', 'both'
+    occurrence_pool: occurrences (eg an OccurrenceQuerySet or a MergedOccurrenceQuerySet) to show as well as those of events_pool.
     """
     if week_start is None:
         week_start = eventtools_settings.FIRST_DAY_OF_WEEK
@@ -40,12 +41,24 @@ def month_calendar(context, events_pool=[], month=None, show_header=True, select
 
     if isinstance(events_pool, EventModel):
         events_pool = [events_pool]
-    
-    for event in events_pool:
-        occs = event.occurrences.between(
-            month_calendar[0][0], month_calendar[-1][-1])
-        for occ in occs:
-            events_by_date.setdefault(occ.start_date(), []).append(occ.event)
+
+    # one query per occurrence model, rather than one per event
+    pools = []
+    if hasattr(events_pool, 'occurrences'): # an EventQuerySet or manager
+        pools.append(events_pool.occurrences())
+    else:
+        events_by_model = {}
+        for event in events_pool:
+            events_by_model.setdefault(type(event), []).append(event)
+        for model, events in events_by_model.items():
+            pools.append(model.Occurrence().objects.filter(event__in=events))
+    if occurrence_pool is not None:
+        pools.append(occurrence_pool)
+
+    # multi-day occurrences are shown on each of their days
+    for pool in pools:
+        for day, occs in pool.group_by_day(month_calendar[0][0], month_calendar[-1][-1]).items():
+            events_by_date.setdefault(day, []).extend(occ.event for occ in occs)
 
     # annotate each day with a list of class names that describes their status in the calendar - not_in_month, today, selected
     def annotate(day):
@@ -37,6 +37,7 @@ class TestGEvent(EventModel):
         
     class EventMeta:
         fields_to_inherit = ['name', 'slug', 'venue']
+        occurrence_span = True
 
 class TestGenerator(GeneratorModel):
     event = models.ForeignKey(TestGEvent, related_name="generators")    
@@ -46,3 +47,5 @@ class TestGOccurrence(OccurrenceModel):
     event = models.ForeignKey(TestGEvent, related_name="occurrences")
     status = models.CharField(max_length=20, blank=True, null=True, choices=settings.OCCURRENCE_STATUS_CHOICES)
 
+    class OccurrenceMeta:
+        day_buckets = True
@@ -3,7 +3,8 @@ from _inject_app import TestCaseWithApp as AppTestCase
 from eventtools_testapp.models import *
 from datetime import date, time, datetime, timedelta
 from _fixture import bigfixture, reload_films
-from eventtools.utils import dateranges
+from eventtools.utils import dateranges, quantized_now
+from eventtools.conf import settings
 
 class TestTestEvents(AppTestCase):
     
@@ -203,7 +204,44 @@ class TestTestEvents(AppTestCase):
         self.ae(set(c), set([self.talk, self.film_with_popcorn]))
         c = TestEvent.eventobjects.closing_on(self.day1)
         self.ae(set(c), set([self.film]))
-        
+
+        # the opening and closing occurrences of a set of events are found in one query
+        events = TestEvent.eventobjects.having_occurrences()
+        with self.assertNumQueries(1):
+            opening = set(events.opening_occurrences())
+        with self.assertNumQueries(1):
+            closing = set(events.closing_occurrences())
+        self.ae(opening, set(e.opening_occurrence() for e in events))
+        self.ae(closing, set(e.closing_occurrence() for e in events))
+        
+    def test_occurrence_summary(self):
+        """
+        with_occurrence_summary() annotates events with their first start, last end, number of occurrences and next
+        start, in one query.
+        """
+        with self.assertNumQueries(1):
+            events = list(TestEvent.eventobjects.with_occurrence_summary())
+        # "now" is passed as a query parameter
+        qs = TestEvent.eventobjects.with_occurrence_summary()
+        sql, params = qs.query.get_compiler(qs.db).as_sql()
+        self.assertTrue([p for p in params if isinstance(p, datetime)])
+        now = quantized_now(settings.NOW_QUANTUM)
+        for e in events:
+            occs = list(e.occurrences.all())
+            self.ae(e.occurrence_count, len(occs))
+            self.ae(e.has_occurrences(), len(occs))
+            if occs:
+                self.ae(e.first_start, e.opening_occurrence().start)
+                self.ae(e.last_end, max(o.end for o in occs))
+            else:
+                self.ae(e.first_start, None)
+                self.ae(e.last_end, None)
+            upcoming = [o.start for o in occs if o.start >= now]
+            if upcoming:
+                self.ae(e.next_start, min(upcoming))
+            else:
+                self.ae(e.next_start, None)
+
     def test_GET(self):
         """        
         a (GET) dictionary, containing date(time) from and to parameters can be passed.
@@ -214,7 +252,34 @@ class TestTestEvents(AppTestCase):
         self.ae(list(TestOccurrence.objects.from_GET({'startdate': '2010-10-10'})[0]), list(TestOccurrence.objects.after(self.day1)))
         self.ae(list(TestOccurrence.objects.from_GET({'enddate': '2010-10-11'})[0]), list(TestOccurrence.objects.before(self.day2).reverse()))
         self.ae(list(TestOccurrence.objects.from_GET({'startdate': '2010-10-10', 'enddate': '2010-10-11'})[0]), list(TestOccurrence.objects.between(self.day1, self.day2)))
-    
+
+        # ISO dates are parsed without dateutil, but other formats still work, and give the same query.
+        iso_qs, iso_bounds = TestOccurrence.objects.from_GET({'startdate': '2010-10-10T09:30', 'enddate': '2010-10-11'})
+        fuzzy_qs, fuzzy_bounds = TestOccurrence.objects.from_GET({'startdate': '10 Oct 2010 9:30am', 'enddate': 'October 11, 2010'})
+        self.ae(iso_bounds, (datetime(2010,10,10,9,30), datetime(2010,10,11)))
+        self.ae(fuzzy_bounds, iso_bounds)
+        self.ae(str(fuzzy_qs.query), str(iso_qs.query))
+
+        # the query is memoized by the GET values, so a repeated range isn't parsed again. The results of a date range
+        # are cached (if OCCURRENCE_CACHE_TIMEOUT is set), but forthcoming() depends on now, so it isn't.
+        from eventtools.models.occurrence import _compiled_GET
+        self.assertTrue(('2010-10-10T09:30', '2010-10-11') in _compiled_GET)
+        self.assertTrue(('10 Oct 2010 9:30am', 'October 11, 2010') in _compiled_GET)
+        self.assertTrue(iso_qs._cache_results)
+        self.assertFalse(TestOccurrence.objects.from_GET()[0]._cache_results)
+
+        from eventtools import settings as eventtools_settings
+        eventtools_settings.OCCURRENCE_CACHE_TIMEOUT = 60
+        try:
+            first_page = lambda: list(TestOccurrence.objects.from_GET({'startdate': '2010-10-10'})[0][:20])
+            first_page()
+            self.assertNumQueries(0, first_page)
+            o = TestOccurrence.objects.all()[0]
+            o.save()
+            self.assertNumQueries(1, first_page)
+        finally:
+            eventtools_settings.OCCURRENCE_CACHE_TIMEOUT = None
+
     def test_change_cascade(self):       
         """
         TestEvents are in an mptt tree, which indicates parents (more general) and children (more specific).
@@ -250,6 +315,18 @@ class TestTestEvents(AppTestCase):
         # reload everything
         reload_films(self)
 
+        # the change doesn't reach past a descendant with its own value, even to its descendants with the old value.
+        season = TestEvent.eventobjects.create(name="Season")
+        gala = TestEvent.eventobjects.create(parent=season, name="Gala")
+        gala_night = TestEvent.eventobjects.create(parent=gala.reload(), name="Season")
+        season_night = TestEvent.eventobjects.create(parent=season.reload(), name="Season")
+        season = season.reload()
+        season.name = "Festival"
+        season.save()
+        self.ae(season_night.reload().name, "Festival")
+        self.ae(gala.reload().name, "Gala")
+        self.ae(gala_night.reload().name, "Season")
+
     # come back to this one (works in admin!)
     # def test_tree_creation(self):
     #     """
@@ -273,6 +350,33 @@ class TestTestEvents(AppTestCase):
     #     self.ae(self.next_new_film.name, self.film.name)
     #     self.ae(self.next_new_film.slug, 'new-slug')        
 
+    def test_inherited_defaults(self):
+        """
+        An event created with a parent takes the parent's values of the fields in fields_to_inherit, unless they are
+        given.
+        """
+        child = TestEvent(parent=self.film)
+        self.ae((child.name, child.slug, child.venue_id), (self.film.name, self.film.slug, self.film.venue_id))
+        child = TestEvent(parent=self.film, name="Film Night (with popcorn)", venue=None)
+        self.ae((child.name, child.slug, child.venue_id), ("Film Night (with popcorn)", self.film.slug, None))
+        # not inherited
+        self.ae(TestEvent(parent=self.film).difference_from_parent, None)
+        # without a parent, the fields' own defaults are used
+        self.ae(TestEvent().slug, "the-slug")
+        child = TestEvent.eventobjects.create(parent=self.talk)
+        self.ae(child.reload().name, self.talk.name)
+
+        # benchmark_event_init times instantiation inheriting each number of the fields
+        from StringIO import StringIO
+        from django.core.management import call_command
+        out = StringIO()
+        call_command('benchmark_event_init', 'eventtools_testapp.TestEvent', number=10, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.ae(len(lines), 4)
+        self.assertTrue(lines[0].startswith('TestEvent, inheriting nothing: '))
+        self.assertTrue(lines[3].startswith('TestEvent, inheriting name, slug, venue: '))
+        self.ae(TestEvent._inherited_fields, [('name', 'name'), ('slug', 'slug'), ('venue', 'venue_id')])
+
     def test_tree_queries(self):
         """
         Sometimes you really do want to list of events, not occurrences, (e.g. events by tag, in alpha order).
@@ -343,6 +447,13 @@ class TestTestEvents(AppTestCase):
         self.assertEqual(list(woph), [self.has_no_occurrences, self.has_some_occurrences])
         self.assertEqual(list(woah), [self.has_no_occurrences, self.has_some_occurrences])
 
+        # each is a single query, however big the tree is
+        with self.assertNumQueries(1):
+            self.assertEqual(list(tree.with_descendants_having(name__contains="more", include_self=False)), [self.has_no_occurrences, self.has_some_occurrences])
+        with self.assertNumQueries(1):
+            self.assertEqual(list(tree.without_ancestors_having(name__contains="no")), [self.has_no_occurrences])
+        self.assertEqual(list(tree.without_children_having(pk__in=[])), list(tree))
+
         objects_having_occurrences = tree.having_occurrences()
         objects_having_no_occurrences = tree.having_no_occurrences()
         
@@ -350,8 +461,11 @@ class TestTestEvents(AppTestCase):
         self.assertEqual(list(objects_having_no_occurrences), [self.has_no_occurrences])        
         
         #a useful derivative
-        highest_having_occurrences = tree.highest_having_occurrences()
-        self.assertEqual(list(highest_having_occurrences), [self.has_some_occurrences])
+        with self.assertNumQueries(2):
+            highest_having_occurrences = tree.highest_having_occurrences()
+            self.assertEqual(list(highest_having_occurrences), [self.has_some_occurrences])
+        # ancestors outside the queryset count too
+        self.assertEqual(list(TestEvent.eventobjects.filter(pk=self.has_some_more_occurrences.pk).highest_having_occurrences()), [])
         
         #get the highest ancestor of self that has occurrences (if any). This could be a good 'normalisation' process.
         self.ae(self.has_some_more_occurrences.highest_ancestor_having_occurrences(), self.has_some_occurrences)
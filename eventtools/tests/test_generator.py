@@ -3,11 +3,14 @@ from django.test import TestCase
 from _inject_app import TestCaseWithApp as AppTestCase
 from eventtools_testapp.models import *
 from datetime import date, time, datetime, timedelta
+from itertools import islice
 from _fixture import generator_fixture
 from eventtools.utils import datetimeify
 from dateutil.relativedelta import relativedelta
 from django.core.urlresolvers import reverse
+from django.core.management import call_command
 from eventtools.models import Rule
+from eventtools.utils import parse_isoformat
 
 class TestGenerators(AppTestCase):
     
@@ -30,7 +33,7 @@ class TestGenerators(AppTestCase):
         The preset is in settings. The preset period is continually updated.
         
         Every time a generator is saved, it does its generating.
-        Every time an event is saved, generators with a rule and no repeat_until do their generating.
+        Generators with a rule and no repeat_until are extended by the `extend_generators` management command.
 
         A generator will not save occurrences for an event that are the same as occurrences already in the database (even
         if they were created by another generator). However, occurrences that differ only in start time or end time ARE
@@ -48,18 +51,195 @@ class TestGenerators(AppTestCase):
         
         self.assertTrue(self.endless_generator.occurrences.count() > 52)
         
-        #test re-save event resaves 'boundless' generators.
+        #test the extend_generators command extends 'boundless' generators (and re-saving the event doesn't).
         self.endless_generator.occurrences.all().delete()
         self.endless_generator.reset_exceptions()
         self.ae(self.endless_generator.occurrences.count(), 0)
         self.bin_night.save()
+        self.ae(self.endless_generator.occurrences.count(), 0)
+        call_command('extend_generators', verbosity=0)
         self.assertTrue(self.endless_generator.occurrences.count() > 52)
+        self.assertTrue(self.endless_generator.reload().materialized_until > datetime.now())
 
         #test dupes are not created.
         self.ae(self.dupe_weekly_generator.occurrences.count(), 0)
 
         self.ae(self.weekly_generator.robot_description(), "1 January 2010, 10:30-11:30am, repeating weekly until 29 January 2010")
 
+    def test_bulk_generation(self):
+        """
+        Generating checks for existing occurrences in a single query and inserts the missing ones in batches, so
+        re-generating a long-running generator doesn't cost a query per date.
+        """
+        daily = Rule.objects.create(frequency = "DAILY")
+        g = self.furniture_collection.generators.create(event_start=datetime(2009,1,1,9,00), event_end=datetime(2009,1,1,10,00), rule=daily, repeat_until=date(2011,12,31))
+        self.ae(g.occurrences.count(), 1095)
+        self.ae(g.occurrences.all()[0].end, datetime(2009,1,1,10,00))
+        self.ae(g.occurrences.reverse()[0].start, datetime(2011,12,31,9,00))
+
+        # nothing to add: one query to find out.
+        self.assertNumQueries(1, g.generate, full=True)
+        self.ae(g.occurrences.count(), 1095)
+
+        # occurrences that exist for the event (from any generator) aren't duplicated.
+        g2 = self.furniture_collection.generators.create(event_start=datetime(2011,12,25,9,00), event_end=datetime(2011,12,25,10,00), rule=daily, repeat_until=date(2012,1,5))
+        self.ae(g2.occurrences.count(), 5)
+        self.ae(self.furniture_collection.occurrences.count(), 1100)
+
+    def test_bulk_timeshift(self):
+        """
+        Changing the timing of a generator shifts its occurrences with a few UPDATE statements, rather than saving each
+        occurrence. The old start of each shifted occurrence becomes an exception, as if it had been saved.
+        """
+        daily = Rule.objects.create(frequency = "DAILY")
+        g = self.furniture_collection.generators.create(event_start=datetime(2010,1,1,9,00), event_end=datetime(2010,1,1,10,00), rule=daily, repeat_until=date(2010,12,31))
+        self.ae(g.occurrences.count(), 365)
+
+        # time only
+        g.event_start = datetime(2010,1,1,9,30)
+        g.event_end = datetime(2010,1,1,10,30)
+        g.save()
+        self.ae(g.occurrences.count(), 365)
+        self.ae(set((o.start.time(), o.end.time()) for o in g.occurrences.all()), set([(time(9,30), time(10,30))]))
+        g = g.reload()
+        self.assertTrue(g.is_exception(datetime(2010,6,1,9,00)))
+        self.assertFalse(g.is_exception(datetime(2010,6,1,9,30)))
+
+        # dates (and times), backwards
+        g.event_start = datetime(2009,12,31,8,00)
+        g.event_end = datetime(2009,12,31,9,00)
+        g.save()
+        self.ae(g.occurrences.all()[0].start, datetime(2009,12,31,8,00))
+        # the new rule reaches one day further before repeat_until.
+        self.ae(g.occurrences.count(), 366)
+        self.ae(g.occurrences.reverse()[0].end, datetime(2010,12,31,9,00))
+        self.ae(set((o.start.time(), o.end.time()) for o in g.occurrences.all()), set([(time(8,00), time(9,00))]))
+
+        # end only
+        g.event_end = datetime(2009,12,31,11,00)
+        g.save()
+        self.ae(set(o.end.time() for o in g.occurrences.all()), set([time(11,00)]))
+        self.assertFalse(g.reload().is_exception(datetime(2010,6,1,8,00)))
+
+    def test_watermark(self):
+        """
+        Generators remember how far they have generated in `materialized_until`. Generating again only looks at the
+        dates after that, so occurrences that were deleted without becoming exceptions aren't recreated unless the whole
+        rule is generated again, or the timing or rule of the generator changes.
+        """
+        self.ae(self.weekly_generator.materialized_until, datetime.combine(date(2010,1,29), time.max))
+        self.ae(self.weekly_generator.reload().materialized_until, datetime.combine(date(2010,1,29), time.max))
+        self.ae(self.one_off_generator.materialized_until, None)
+
+        self.assertTrue(self.endless_generator.materialized_until > datetime.now())
+
+        # asking about exceptions doesn't write anything, or reset the watermark.
+        g = self.weekly_generator.reload()
+        g.exceptions = None
+        self.assertNumQueries(0, g.is_exception, datetime(2010,1,8,10,30))
+        self.ae(g.reload().materialized_until, datetime.combine(date(2010,1,29), time.max))
+
+        # nothing new to generate, and nothing to record.
+        self.assertNumQueries(0, self.weekly_generator.generate)
+
+        TestGOccurrence.objects.filter(generator=self.weekly_generator).update(generator=None, event=self.furniture_collection)
+        self.weekly_generator.generate()
+        self.ae(self.weekly_generator.occurrences.count(), 0)
+        self.weekly_generator.generate(full=True)
+        self.ae(self.weekly_generator.occurrences.count(), 5)
+
+        # extending repeat_until only generates the new dates.
+        self.weekly_generator.repeat_until = date(2010,2,12)
+        self.weekly_generator.save()
+        self.ae(self.weekly_generator.occurrences.count(), 7)
+        self.ae(self.weekly_generator.materialized_until, datetime.combine(date(2010,2,12), time.max))
+
+        # changing the timing means starting again.
+        self.weekly_generator.event_start = datetime(2010,1,1,10,00)
+        self.weekly_generator.save()
+        self.ae(self.weekly_generator.materialized_until, datetime.combine(date(2010,2,12), time.max))
+        self.ae([o.start.time() for o in self.weekly_generator.occurrences.all()], [time(10,00)] * 7)
+
+    def test_regenerate_command(self):
+        """
+        The regenerate_generators command generates every generator past its watermark, or (with --full) every date
+        of every rule again.
+        """
+        g = self.weekly_generator
+        end = datetime.combine(date(2010,1,29), time.max)
+        TestGOccurrence.objects.filter(generator=g).update(generator=None, event=self.furniture_collection)
+        TestGenerator.objects.filter(pk=g.pk).update(materialized_until=None)
+
+        call_command('regenerate_generators', workers=1, verbosity=0)
+        self.ae(g.occurrences.count(), 5)
+        self.ae(g.reload().materialized_until, end)
+
+        # past the watermark, there's nothing to do, unless every date is checked again.
+        TestGOccurrence.objects.filter(generator=g).update(generator=None, event=self.furniture_collection)
+        call_command('regenerate_generators', workers=1, verbosity=0)
+        self.ae(g.occurrences.count(), 0)
+        call_command('regenerate_generators', workers=1, full=True, split='id', verbosity=0)
+        self.ae(g.occurrences.count(), 5)
+        self.ae(g.reload().materialized_until, end)
+
+    def test_expansion_after(self):
+        """
+        Generating past the watermark expands the rule from around the watermark rather than from event_start, with
+        the same dates, as is a window of virtual occurrences. Rules with a count are still expanded from the start.
+        """
+        after = datetime(2030,6,15,12,00)
+        def dates_after(rs):
+            return list(islice((d for d in rs if d > after), 10))
+        g = self.endless_generator
+        for params in ("", "interval:3", "byweekday:1,5"):
+            g.rule = Rule.objects.create(frequency="WEEKLY", params=params)
+            self.ae(dates_after(g.rruleset(after=after)), dates_after(g.rruleset()))
+            self.assertTrue(g.rruleset(after=after)[0] > datetime(2030,1,1))
+            window = (after, after + timedelta(28))
+            self.ae([start for start, end in g.window_spans(*window)], g.rruleset().between(*window, inc=True))
+        g.rule = Rule.objects.create(frequency="MONTHLY", params="bymonthday:-1;interval:5")
+        self.ae(dates_after(g.rruleset(after=after)), dates_after(g.rruleset()))
+        g.rule = Rule.objects.create(frequency="DAILY", params="count:10000")
+        self.ae(g.rruleset(after=after)[0], g.event_start)
+
+    def test_rule_cache(self):
+        """
+        Rules are compiled once per process. Saving a rule recompiles it, as does a change to an unsaved instance.
+        """
+        from eventtools.models.rule import _compiled_rules
+        dt = datetime(2010,1,1,9,00)
+
+        self.ae(list(self.weekly.get_rrule(dtstart=dt)[:2]), [dt, datetime(2010,1,8,9,00)])
+        self.assertTrue(self.weekly.pk in _compiled_rules)
+        compiled = _compiled_rules[self.weekly.pk]
+        self.weekly.get_rrule(dtstart=dt)
+        self.assertTrue(_compiled_rules[self.weekly.pk] is compiled)
+
+        self.weekly.params = "interval:2"
+        self.ae(list(self.weekly.get_rrule(dtstart=dt)[:2]), [dt, datetime(2010,1,15,9,00)])
+
+        self.weekly.frequency = "DAILY"
+        self.weekly.params = ""
+        self.weekly.save()
+        self.assertFalse(self.weekly.pk in _compiled_rules)
+        self.ae(list(Rule.objects.get(pk=self.weekly.pk).get_rrule(dtstart=dt)[:2]), [dt, datetime(2010,1,2,9,00)])
+
+        # complex rules override the rest, unless they can't be parsed.
+        self.weekly.complex_rule = "FREQ=MONTHLY;BYMONTHDAY=3"
+        self.ae(list(self.weekly.get_rrule(dtstart=dt)[:2]), [datetime(2010,1,3,9,00), datetime(2010,2,3,9,00)])
+        self.weekly.complex_rule = "FREQ=FORTNIGHTLY"
+        self.ae(list(self.weekly.get_rrule(dtstart=dt)[:2]), [dt, datetime(2010,1,2,9,00)])
+        self.weekly.complex_rule = u"FREQ=MONTHLY;BYMONTHDAY=3;X-NOTE=caf\xe9"
+        self.ae(list(self.weekly.get_rrule(dtstart=dt)[:2]), [dt, datetime(2010,1,2,9,00)])
+
+        # complex rules are parsed once too, and only the start changes.
+        self.weekly.complex_rule = "FREQ=MONTHLY;BYMONTHDAY=3"
+        self.weekly.get_rrule(dtstart=dt)
+        compiled = _compiled_rules[self.weekly.pk]
+        later = datetime(2011,6,1,18,30)
+        self.ae(list(self.weekly.get_rrule(dtstart=later)[:2]), [datetime(2011,6,3,18,30), datetime(2011,7,3,18,30)])
+        self.assertTrue(_compiled_rules[self.weekly.pk] is compiled)
+
     def test_all_day(self):
         """
         If the start time of a generator is time.min and the end time is time.max, then the generator generates all_day
@@ -198,6 +378,279 @@ class TestGenerators(AppTestCase):
         self.assertTrue(bb3 in self.weekly_generator.occurrences.all())
         self.ae(bb3.event, self.furniture_collection)
     
+    def test_diff_changes(self):
+        """
+        When a generator is saved with diff=True and its rule or repeat_until has changed, the occurrences the new
+        settings don't produce are deleted, unless they have been edited (moved, or any other field changed). New
+        occurrences are generated as usual.
+        """
+        self._reset_generator_changes()
+        daily = Rule.objects.create(frequency = "DAILY")
+        g = self.changeable_generator
+        g.rule = daily
+        g.save(diff=True)
+        self.ae(g.occurrences.count(), 9)
+        for occ in self.original_occurrences:
+            self.assertTrue(g.occurrences.filter(id=occ.id).exists())
+
+        edited = g.occurrences.get(start=datetime(2010,10,6,8,30))
+        edited.start = datetime(2010,10,6,10,00)
+        edited.end = datetime(2010,10,6,11,00)
+        edited.save()
+        g.occurrences.filter(start=datetime(2010,10,7,8,30)).update(status='cancelled')
+
+        g = g.reload()
+        g.repeat_until = datetime(2010,10,4)
+        g.save(diff=True)
+        self.ae([o.start for o in g.occurrences.all()], [
+            datetime(2010,10,1,8,30),
+            datetime(2010,10,1,13,30), #freak
+            datetime(2010,10,2,8,30),
+            datetime(2010,10,3,8,30),
+            datetime(2010,10,4,8,30),
+            datetime(2010,10,6,10,00), #edited
+            datetime(2010,10,7,8,30), #cancelled
+        ])
+        # the deleted occurrences weren't cancelled, so they aren't exceptions
+        self.assertFalse(g.reload().is_exception(datetime(2010,10,5,8,30)))
+
+    def test_virtual(self):
+        """
+        Virtual generators don't store occurrences. Their occurrences are computed for the requested window, and only
+        stored if they are saved (eg because they've been edited or cancelled).
+        """
+        hourly = Rule.objects.create(frequency = "HOURLY")
+        g = self.furniture_collection.generators.create(event_start=datetime(2010,1,1,9,00), event_end=datetime(2010,1,1,9,30), rule=hourly, virtual=True)
+        self.ae(g.occurrences.count(), 0)
+
+        occs = g.occurrences_between(date(2010,6,1), date(2010,6,1))
+        self.ae(len(occs), 24)
+        self.ae((occs[0].start, occs[0].end), (datetime(2010,6,1,0,00), datetime(2010,6,1,0,30)))
+        self.ae([o.pk for o in occs], [None] * 24)
+
+        # cancel one
+        occs[1].status = 'cancelled'
+        occs[1].save()
+        # move one
+        occs[2].start = datetime(2010,6,1,2,15)
+        occs[2].end = datetime(2010,6,1,2,45)
+        occs[2].save()
+        # and skip one
+        g.add_exception(datetime(2010,6,1,3,00))
+
+        self.ae(g.occurrences.count(), 2)
+        occs = g.occurrences_between(date(2010,6,1), date(2010,6,1))
+        self.ae(len(occs), 23)
+        self.ae([(o.start.time(), o.status) for o in occs[1:4]], [(time(1,00), 'cancelled'), (time(2,15), None), (time(4,00), None)])
+        self.assertTrue(g.reload().is_exception(datetime(2010,6,1,2,00)))
+
+        # the manager can query many generators, virtual or not.
+        occs = self.bin_night.generators.occurrences_between(date(2010,1,1), date(2010,1,7))
+        self.ae([o.start.date() for o in occs], [date(2010,1,1), date(2010,1,2), date(2010,1,3), date(2010,1,4)])
+        self.ae(len(TestGenerator.objects.occurrences_between(date(2010,6,1), date(2010,6,1))), 23)
+
+    def test_merged(self):
+        """
+        Stored occurrences can be merged with the occurrences of virtual generators, in a lazy queryset-alike that can
+        be filtered, sliced, counted and paginated.
+        """
+        from django.core.paginator import Paginator
+        from django.db.models import Q
+        daily = Rule.objects.create(frequency = "DAILY")
+        g = self.furniture_collection.generators.create(event_start=datetime(2010,1,1,9,00), rule=daily, virtual=True)
+
+        merged = TestGOccurrence.objects.with_virtual().between(date(2010,1,1), date(2010,1,7))
+        self.ae(merged.count(), 11)
+        starts = [o.start for o in merged]
+        self.ae(len(starts), 11)
+        self.ae(starts, sorted(starts))
+        self.ae([o.start for o in merged[2:5]], starts[2:5])
+        self.ae(merged[0].start, datetime(2010,1,1,9,00))
+
+        self.ae(len(merged.filter(event=self.bin_night)), 4)
+        self.ae(len(merged.filter(event=self.furniture_collection)), 7)
+        self.ae(len(merged.filter(event__name=self.furniture_collection.name)), 7)
+        self.ae(len(merged.filter(Q(event=self.bin_night) | Q(event__name=self.furniture_collection.name))), 11)
+        self.ae(len(merged.filter(~Q(event=self.bin_night))), 7)
+        self.ae(list(merged.events()), [self.bin_night, self.furniture_collection])
+
+        paginator = Paginator(merged, 5)
+        self.ae(paginator.num_pages, 3)
+        self.ae([o.start for o in paginator.page(3).object_list], starts[10:])
+
+        from eventtools.utils.keyset import keyset_page
+        page = keyset_page(merged, per_page=5)
+        page = keyset_page(merged, page.next_token, per_page=5)
+        self.ae([o.start for o in page], starts[5:10])
+        page = keyset_page(merged, page.next_token, per_page=5)
+        self.ae([o.start for o in page], starts[10:])
+        self.assertFalse(page.has_next)
+        page = keyset_page(merged, page.previous_token, per_page=5)
+        self.ae([o.start for o in page], starts[5:10])
+
+        # endless windows stop at the generators' horizons.
+        future = TestGOccurrence.objects.with_virtual().forthcoming()
+        self.ae(len(future[:3]), 3)
+        self.assertTrue(future.count() > 365)
+        self.assertTrue(len(future) > 365)
+        self.ae(len(list(future)), len(future))
+        self.assertTrue(future.reverse()[0].start > future[0].start)
+
+        # reversed
+        self.ae([o.start for o in merged.reverse()], list(reversed(starts)))
+
+        # the views can show a stored occurrence of a merged pool
+        from django.http import Http404
+        from eventtools.views import EventViews
+        views = EventViews()
+        views.occurrence_qs = TestGOccurrence.objects.with_virtual()
+        occ = TestGOccurrence.objects.all()[0]
+        self.ae(views._occurrence_context(None, occ.id)['occurrence'], occ)
+        self.assertRaises(Http404, views._occurrence_context, None, 0)
+
+    def test_bulk_exceptions(self):
+        """
+        Many exceptions can be added or removed in a single write. Exceptions are excluded from the generator's rule,
+        so they are never generated.
+        """
+        season = [datetime(2010,1,8,10,30), datetime(2010,1,15,10,30), datetime(2010,1,22,10,30)]
+        self.weekly_generator.occurrences.filter(start__in=season).update(generator=None, event=self.furniture_collection)
+        self.assertNumQueries(1, self.weekly_generator.add_exceptions, season)
+        self.ae(sorted(self.weekly_generator.reload().exception_dates()), season)
+        self.ae(list(self.weekly_generator.generate_dates()), [datetime(2010,1,1,10,30), datetime(2010,1,29,10,30)])
+
+        self.weekly_generator.generate(full=True)
+        self.ae(self.weekly_generator.occurrences.count(), 2)
+
+        self.assertNumQueries(1, self.weekly_generator.remove_exceptions, season[:2])
+        self.weekly_generator = self.weekly_generator.reload()
+        self.ae(self.weekly_generator.exception_dates(), season[2:])
+        self.weekly_generator.generate()
+        self.ae(self.weekly_generator.occurrences.count(), 4)
+
+        # exceptions keyed by aware datetimes keep their offset, and are excluded in the same local time.
+        from dateutil import tz
+        aware = datetime(2010,1,29,10,30, tzinfo=tz.tzoffset(None, 10 * 3600))
+        self.weekly_generator.add_exception(aware)
+        self.assertTrue(aware.isoformat() in [d.isoformat() for d in self.weekly_generator.reload().exception_dates()])
+        self.assertTrue(datetime(2010,1,29,10,30) not in list(self.weekly_generator.generate_dates()))
+        west = datetime(2010,1,1,10,30,0,500, tzinfo=tz.tzoffset(None, -(5 * 3600 + 30 * 60)))
+        self.ae(parse_isoformat(west.isoformat()), west)
+        self.ae(parse_isoformat('2010-01-01T10:30:00Z').utcoffset(), timedelta(0))
+
+    def test_day_buckets(self):
+        """
+        TestGOccurrence has day buckets: a row for each date each occurrence is on, which answer day queries. They are
+        kept up to date when occurrences are generated, timeshifted, saved and deleted.
+        """
+        Day = TestGOccurrence._occurrence_meta.day_model
+        g = self.furniture_collection.generators.create(event_start=datetime(2010,3,1,18,00), event_end=datetime(2010,3,3,12,00), rule=self.weekly, repeat_until=date(2010,3,31))
+        self.ae(g.occurrences.count(), 5)
+        self.ae(Day.objects.filter(occurrence__generator=g).count(), 15)
+        self.ae(set(g.occurrences.overlapping_on(date(2010,3,2))), set(g.occurrences.starts_on(date(2010,3,1))))
+        self.ae(list(g.occurrences.overlapping_on(date(2010,3,4))), [])
+
+        g.event_end = datetime(2010,3,1,20,00)
+        g.save()
+        self.ae(Day.objects.filter(occurrence__generator=g).count(), 5)
+        self.ae(list(g.occurrences.overlapping_on(date(2010,3,2))), [])
+
+        occ = g.occurrences.all()[0]
+        occ.end = datetime(2010,3,2,10,00)
+        occ.save()
+        self.ae(g.occurrences.days_between(date(2010,3,1), date(2010,3,2)), [(date(2010,3,1), occ), (date(2010,3,2), occ)])
+
+        g = g.reload()
+        g.repeat_until = datetime(2010,3,15)
+        g.save(diff=True)
+        self.ae(g.occurrences.count(), 3)
+        self.ae(Day.objects.filter(occurrence__generator=g).count(), 4)
+
+        total = Day.objects.count()
+        Day.objects.all().delete()
+        call_command('rebuild_occurrence_days', verbosity=0)
+        self.ae(Day.objects.count(), total)
+
+        g.occurrences.all().delete()
+        self.ae(Day.objects.count(), total - 4)
+
+    def test_occurrence_span(self):
+        """
+        TestGEvent stores the span of its occurrences, which is kept up to date when occurrences are generated,
+        timeshifted, saved, moved and deleted (once per event, for a queryset), and answers the opening and closing
+        queries. Saving an event doesn't overwrite its stored span.
+        """
+        def span(event):
+            event = event.reload()
+            return event.opening_start, event.closing_start, event.closing_end
+
+        e = self.furniture_collection
+        self.ae(span(e), (None, None, None))
+        g = e.generators.create(event_start=datetime(2010,3,1,18,00), event_end=datetime(2010,3,1,20,00), rule=self.weekly, repeat_until=date(2010,3,31))
+        self.ae(span(e), (datetime(2010,3,1,18,00), datetime(2010,3,29,18,00), datetime(2010,3,29,20,00)))
+
+        g.event_start = datetime(2010,3,2,18,00)
+        g.event_end = datetime(2010,3,2,19,00)
+        g.save()
+        self.ae(span(e), (datetime(2010,3,2,18,00), datetime(2010,3,30,18,00), datetime(2010,3,30,19,00)))
+
+        occ = e.occurrences.create(start=datetime(2010,2,1,10,00), end=datetime(2010,2,1,11,00))
+        self.ae(span(e)[0], datetime(2010,2,1,10,00))
+        occ.start = datetime(2010,4,1,10,00)
+        occ.end = datetime(2010,4,1,11,00)
+        occ.save()
+        self.ae(span(e), (datetime(2010,3,2,18,00), datetime(2010,4,1,10,00), datetime(2010,4,1,11,00)))
+        occ.delete()
+        self.ae(span(e)[1], datetime(2010,3,30,18,00))
+
+        # saving an event that was loaded before its occurrences changed doesn't write back the old span
+        stale = e.reload()
+        occ = e.occurrences.create(start=datetime(2010,5,1,10,00), end=datetime(2010,5,1,11,00))
+        stale.name = "Furniture Collection"
+        stale.save()
+        self.ae(span(e)[1], datetime(2010,5,1,10,00))
+
+        # moving an occurrence recalculates the span of the event it was loaded with too
+        occ = TestGOccurrence.objects.get(pk=occ.pk)
+        occ.event = self.bin_night
+        occ.save()
+        self.ae(span(e)[1], datetime(2010,3,30,18,00))
+        occ.delete()
+
+        self.ae(list(TestGEvent.eventobjects.opening_on(date(2010,3,2))), [e])
+        self.ae(list(TestGEvent.eventobjects.closing_between(date(2010,3,30), date(2010,4,30))), [e])
+        self.ae(list(TestGEvent.eventobjects.opening_after(date(2010,3,3))), [])
+
+        TestGEvent.eventobjects.update(opening_start=None, closing_start=None, closing_end=None)
+        call_command('rebuild_occurrence_spans', verbosity=0)
+        self.ae(span(e), (datetime(2010,3,2,18,00), datetime(2010,3,30,18,00), datetime(2010,3,30,19,00)))
+
+        # deleting many occurrences recalculates the span once
+        recalculated = []
+        update_occurrence_spans = TestGEvent.update_occurrence_spans
+        TestGEvent.update_occurrence_spans = classmethod(
+            lambda cls, event_ids: recalculated.append(set(event_ids)) or update_occurrence_spans(event_ids))
+        try:
+            e.occurrences.all().delete()
+        finally:
+            del TestGEvent.update_occurrence_spans
+        self.ae(recalculated, [set([e.pk])])
+        self.ae(span(e), (None, None, None))
+
+        # deleting an event doesn't recalculate its span as each of its occurrences goes
+        e.occurrences.create(start=datetime(2010,3,2,18,00), end=datetime(2010,3,2,19,00))
+        e.occurrences.create(start=datetime(2010,3,9,18,00), end=datetime(2010,3,9,19,00))
+        recalculated = []
+        TestGEvent.update_occurrence_spans = classmethod(
+            lambda cls, event_ids: recalculated.append(set(event_ids)) or update_occurrence_spans(event_ids))
+        try:
+            e.delete()
+        finally:
+            del TestGEvent.update_occurrence_spans
+        self.ae(recalculated, [])
+        from eventtools.models.event import _events_deleting
+        self.ae(_events_deleting(), set())
+
     def _reset_generator_changes(self):
         self.bin_night.occurrences.all().delete()
         self.changeable_generator = self.bin_night.generators.create(
@@ -6,6 +6,7 @@ from datetime import date, time, datetime, timedelta
 from _fixture import bigfixture, reload_films
 from eventtools.utils import datetimeify
 from dateutil.relativedelta import relativedelta
+from django.core.management import call_command
 
 class TestOccurrences(AppTestCase):
     """
@@ -131,6 +132,161 @@ class TestOccurrences(AppTestCase):
         self.assertTrue(o.relative_time_to_go().months < 0)
         self.ae(o2.relative_time_to_go(), None)
 
+    def test_overlapping(self):
+        """
+        You can query for the occurrences that are on at any time in a period, ie that start before it ends and end
+        after it starts, with overlapping() and the overlapping_* shortcuts.
+
+        If OCCURRENCE_MAX_DURATION is set, the same occurrences are found (with a range scan of the (start, end)
+        index), and longer occurrences can't be saved.
+        """
+        e = TestEvent.eventobjects.create(name="event with overlapping occurrences")
+        before = e.occurrences.create(start=datetime(2010,1,1,9,00), end=datetime(2010,1,1,10,00))
+        into = e.occurrences.create(start=datetime(2010,1,1,23,00), end=datetime(2010,1,2,1,00))
+        within = e.occurrences.create(start=datetime(2010,1,2,12,00), end=datetime(2010,1,2,13,00))
+        out_of = e.occurrences.create(start=datetime(2010,1,2,23,00), end=datetime(2010,1,3,1,00))
+        across = e.occurrences.create(start=datetime(2010,1,1,12,00), end=datetime(2010,1,3,12,00))
+
+        self.ae(set(e.occurrences.overlapping_on(date(2010,1,2))), set([into, within, out_of, across]))
+        self.ae(set(e.occurrences.starts_on(date(2010,1,2))), set([within, out_of]))
+        self.ae(set(e.occurrences.overlapping(datetime(2010,1,1,10,00), datetime(2010,1,1,12,00))), set([before, across]))
+        self.ae(set(e.occurrences.overlapping_in_year_of(date(2010,1,2))), set([before, into, within, out_of, across]))
+
+        from eventtools import settings as eventtools_settings
+        eventtools_settings.OCCURRENCE_MAX_DURATION = timedelta(days=2)
+        try:
+            self.ae(set(e.occurrences.overlapping_on(date(2010,1,2))), set([into, within, out_of, across]))
+            self.ae(set(e.occurrences.overlapping_on(date(2010,1,3))), set([out_of, across]))
+            self.assertRaises(AttributeError, e.occurrences.create,
+                start=datetime(2010,1,1,9,00), end=datetime(2010,1,3,10,00))
+        finally:
+            eventtools_settings.OCCURRENCE_MAX_DURATION = None
+
+    def test_group_by_period(self):
+        """
+        You can get the occurrences in a window grouped by day, week, month or year, in one query. Occurrences that
+        span several periods are in each of them.
+        """
+        e = TestEvent.eventobjects.create(name="event with grouped occurrences")
+        fri = e.occurrences.create(start=datetime(2010,1,1,9,00), end=datetime(2010,1,1,10,00))
+        weekend = e.occurrences.create(start=datetime(2010,1,2,20,00), end=datetime(2010,1,4,2,00))
+        feb = e.occurrences.create(start=datetime(2010,2,1,9,00), end=datetime(2010,2,1,10,00))
+
+        with self.assertNumQueries(1):
+            by_day = e.occurrences.group_by_day(date(2010,1,1), date(2010,2,28))
+        self.ae(by_day.keys(), [date(2010,1,1), date(2010,1,2), date(2010,1,3), date(2010,1,4), date(2010,2,1)])
+        self.ae(by_day[date(2010,1,3)], [weekend])
+
+        by_week = e.occurrences.group_by_week(date(2010,1,1), date(2010,2,28))
+        self.ae(by_week.keys(), [date(2009,12,28), date(2010,1,4), date(2010,2,1)]) #weeks start on Monday
+        self.ae(by_week[date(2009,12,28)], [fri, weekend])
+        self.ae(by_week[date(2010,1,4)], [weekend])
+
+        by_month = e.occurrences.group_by_month(date(2010,1,1), date(2010,12,31))
+        self.ae(by_month.items(), [(date(2010,1,1), [fri, weekend]), (date(2010,2,1), [feb])])
+        self.ae(e.occurrences.group_by_year(date(2010,1,2), date(2010,12,31)).items(), [(date(2010,1,1), [weekend, feb])])
+
+        self.assertRaises(ValueError, e.occurrences.group_by_period, 'fortnight', date(2010,1,1), date(2010,1,31))
+
+    def test_counts_by_period(self):
+        """
+        You can count the occurrences that start in each day, week or month of a window in one query, without loading
+        them.
+        """
+        e = TestEvent.eventobjects.create(name="event with counted occurrences")
+        for day in [1, 1, 2, 4, 31]:
+            e.occurrences.create(start=datetime(2010,1,day,9,00), end=datetime(2010,1,day,10,00))
+        e.occurrences.create(start=datetime(2010,3,1,9,00), end=datetime(2010,3,1,10,00))
+
+        with self.assertNumQueries(1):
+            by_day = e.occurrences.counts_by_period('day', date(2010,1,1), date(2010,12,31))
+        self.ae(by_day, [(date(2010,1,1), 2), (date(2010,1,2), 1), (date(2010,1,4), 1), (date(2010,1,31), 1), (date(2010,3,1), 1)])
+        #weeks start on Monday
+        self.ae(e.occurrences.counts_by_period('week', date(2010,1,1), date(2010,12,31)),
+            [(date(2009,12,28), 3), (date(2010,1,4), 1), (date(2010,1,25), 1), (date(2010,3,1), 1)])
+        self.ae(e.occurrences.counts_by_period('month', date(2010,1,1), date(2010,12,31)),
+            [(date(2010,1,1), 5), (date(2010,3,1), 1)])
+        self.ae(e.occurrences.counts_by_period('month', date(2010,1,2), date(2010,1,31)), [(date(2010,1,1), 3)])
+
+        # other pools (eg with virtual occurrences) are counted in python, with the same results
+        from eventtools.models import OccurrenceQuerySetFN
+        self.ae(OccurrenceQuerySetFN.counts_by_period(e.occurrences.all(), 'week', date(2010,1,1), date(2010,12,31)),
+            e.occurrences.counts_by_period('week', date(2010,1,1), date(2010,12,31)))
+
+    def test_indexes(self):
+        """
+        Occurrences are indexed on (start, end) and (event, start, end), and also (generator, start, end) if they have
+        a generator. Generators are indexed on (event, event_start, event_end).
+
+        The explain_occurrence_queries command EXPLAINs each occurrence query, flags those that scan a whole table, and
+        reports those that fail.
+        """
+        from eventtools.models import composite_index_sql
+        self.ae(len(composite_index_sql(TestOccurrence)), 2)
+        self.ae(len(composite_index_sql(TestGOccurrence)), 3)
+        self.assertTrue('event_start' in composite_index_sql(TestGenerator)[0])
+
+        # syncdb created them, and setUp's flush (which sends post_syncdb again) didn't try to create them twice
+        from django.db import connection
+        from eventtools.models.indexes import _index_names
+        names = _index_names(connection, connection.cursor(), TestOccurrence._meta.db_table)
+        if names is not None:
+            self.assertTrue('%s_event_id_start_end' % TestOccurrence._meta.db_table in names)
+
+        from StringIO import StringIO
+        out = StringIO()
+        call_command('explain_occurrence_queries', stdout=out)
+        self.assertTrue('TestOccurrence.overlapping: ' in out.getvalue())
+        self.assertTrue('TestGOccurrence.starts_between: ' in out.getvalue())
+        self.assertTrue(', 0 failed.' in out.getvalue())
+
+        out = StringIO()
+        call_command('explain_occurrence_queries', verbosity=2, stdout=out,
+            event=TestEvent.eventobjects.all()[0].id)
+        self.assertFalse('FAILED' in out.getvalue())
+        if connection.vendor == 'sqlite':
+            # an event's occurrences in a date range are found in the (event, start, end) index
+            self.assertTrue('testoccurrence_event_id_start_end' in out.getvalue())
+
+    def test_cached_queries(self):
+        """
+        If NOW_QUANTUM is set, "now" in forthcoming(), recent(), now_on() and forthcoming_only queries is rounded down
+        to it, so the same query is made for the whole quantum. If OCCURRENCE_CACHE_TIMEOUT is set too, their results
+        are cached until the occurrences change.
+        """
+        from eventtools.utils import quantized_now
+        now = quantized_now(timedelta(minutes=1))
+        self.ae((now.second, now.microsecond), (0, 0))
+        self.ae(quantized_now(timedelta(minutes=15)).minute % 15, 0)
+        before = datetime.now()
+        self.assertTrue(before <= quantized_now(None) <= datetime.now())
+
+        from eventtools import settings as eventtools_settings
+        eventtools_settings.OCCURRENCE_CACHE_TIMEOUT = 60
+        e = TestEvent.eventobjects.create(name="event with cached occurrences")
+        try:
+            # by default "now" is exact, so the queries don't repeat and aren't cached
+            self.ae(eventtools_settings.NOW_QUANTUM, None)
+            list(e.occurrences.forthcoming())
+            self.assertNumQueries(1, lambda: list(e.occurrences.forthcoming()))
+            list(e.occurrences.starts_today(forthcoming_only=True))
+            self.assertNumQueries(1, lambda: list(e.occurrences.starts_today(forthcoming_only=True)))
+            list(e.occurrences.starts_today())
+            self.assertNumQueries(0, lambda: list(e.occurrences.starts_today()))
+
+            eventtools_settings.NOW_QUANTUM = timedelta(days=1)
+            forthcoming = list(e.occurrences.forthcoming())
+            self.assertNumQueries(0, lambda: list(e.occurrences.forthcoming()))
+            self.assertNumQueries(1, lambda: list(e.occurrences.after(date.today())))
+
+            o = e.occurrences.create(start=datetime.now() + timedelta(days=1))
+            self.ae(list(e.occurrences.forthcoming()), forthcoming + [o])
+            o.delete()
+            self.ae(list(e.occurrences.forthcoming()), forthcoming)
+        finally:
+            eventtools_settings.OCCURRENCE_CACHE_TIMEOUT = None
+            eventtools_settings.NOW_QUANTUM = None
+
 """
 TODO
 
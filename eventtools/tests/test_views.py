@@ -40,8 +40,9 @@ class TestViews(AppTestCase):
     
     def test_list_view(self):
         """
-        You can view a paginated list of occurrences for an event qs, following a given day, using ?startdate=2010-10-22&page=2.
-        Each page shows n=20 occurrences and paginates by that amount.
+        You can view a paginated list of occurrences for an event qs, following a given day, using ?startdate=2010-10-22.
+        Each page shows n=20 occurrences and paginates by that amount. Pages link to each other with opaque tokens in
+        ?page=, which point at the occurrence at the edge of the page, so there is no count or offset.
         The occurrences are in chronological order.
         The times of all-day events do not appear.
         If there are no events in a given day, the day is not shown.
@@ -64,7 +65,29 @@ class TestViews(AppTestCase):
         #should have some pagination (6 pages)
         self.assertNotContains(r, "Earlier") #it's the first page
         self.assertContains(r, "Later")
-        self.assertContains(r, "Showing 1&ndash;20&nbsp;of&nbsp;109")
+        self.assertContains(r, "Showing 1 January 2010&ndash;")
+
+        #follow the pages there and back
+        pages = [r.context['occurrence_page']]
+        while r.context['pageinfo'].has_next:
+            r = self.client.get(url, {'startdate':'2010-01-01', 'page': r.context['pageinfo'].next_token})
+            pages.append(r.context['occurrence_page'])
+        self.ae(len(pages), 6)
+        self.ae([o.start for o in sum(pages, [])], [o.start for o in r.context['occurrence_pool']])
+        self.assertNotContains(r, "Later")
+        for page in reversed(pages[:-1]):
+            r = self.client.get(url, {'startdate':'2010-01-01', 'page': r.context['pageinfo'].previous_token})
+            self.ae(r.context['occurrence_page'], page)
+        self.assertFalse(r.context['pageinfo'].has_previous)
+
+        #bad tokens give the first page
+        r = self.client.get(url, {'startdate':'2010-01-01', 'page': '2'})
+        self.ae(r.context['occurrence_page'], pages[0])
+
+        #tokens encode any datetime, even before 1900
+        from eventtools.utils.keyset import _encode, _decode
+        key = (datetime(1850,1,1,10,00), datetime(1850,1,1,12,00,00,500), 3)
+        self.ae(_decode(_encode('n', key)), ('n', key))
 
         self.assertContains(r, "Friday, 1 January 2010", 1) #only print the date once
         self.assertNotContains(r, "Saturday, 2 January 2010") #there are no events
@@ -86,7 +109,7 @@ class TestViews(AppTestCase):
         
         #show a 'not found' message
         r = self.client.get(url, {'startdate':'2020-01-01'})
-        self.assertEqual(r.context['occurrence_page'].count(), 0)
+        self.assertEqual(len(r.context['occurrence_page']), 0)
         self.assertContains(r, "Sorry, no events were found")
         self.assertNotContains(r, "Earlier")
         self.assertNotContains(r, "Later")
@@ -108,6 +131,9 @@ class TestViews(AppTestCase):
         self.assertEqual(len(r.context['occurrence_page']), 5)
         self.assertEqual(r.context['occurrence_page'][0].start.date(), date(2010,1,1))
         self.assertEqual(r.context['occurrence_page'].reverse()[0].start.date(), date(2010,1,5))
+        # the days list the page's occurrences, not the whole pool's
+        days = r.context['occurrence_days']
+        self.ae(set(o.pk for occs in days.values() for o in occs), set(o.pk for o in r.context['occurrence_page']))
 
         self.assertContains(r, "Showing 1&ndash;5&nbsp;January&nbsp;2010")
         self.assertContains(r, '<a href="?startdate=2009-12-27&amp;enddate=2009-12-31">Earlier</a>')
@@ -126,14 +152,29 @@ class TestViews(AppTestCase):
         e = self.daily_tour
         eurl = reverse('event', kwargs={'event_slug': e.slug})
         self.assertEqual(e.get_absolute_url(), eurl)
-        r3 = self.client.get(eurl, {'page': 2})
+        r1 = self.client.get(eurl)
+        self.assertEqual(r1.status_code, 200)
+        self.assertEqual(len(r1.context['occurrence_page']), 20)
+        self.assertNotContains(r1, "Earlier")
+        self.assertContains(r1, "Later")
+
+        #should have some pagination (3 pages), linked by tokens
+        r3 = self.client.get(eurl, {'page': r1.context['pageinfo'].next_token})
         self.assertEqual(r3.status_code, 200)
-        
-        #should have some pagination (3 pages)
-        self.assertEqual(r3.context['occurrence_page'].count(), 20)
+        occurrences = list(e.occurrences.all().order_by('start'))
+        self.assertEqual(len(occurrences), 49)
+        self.assertEqual(r3.context['occurrence_page'], occurrences[20:40])
         self.assertContains(r3, "Earlier")
         self.assertContains(r3, "Later")
-        self.assertContains(r3, "Showing 21&ndash;40&nbsp;of&nbsp;49")
+        self.assertContains(r3, "Showing %s&ndash;%s." % (
+            occurrences[20].start.strftime("%d %B %Y").lstrip('0'),
+            occurrences[39].start.strftime("%d %B %Y").lstrip('0'),
+        ))
+
+        r4 = self.client.get(eurl, {'page': r3.context['pageinfo'].next_token})
+        self.assertEqual(r4.context['occurrence_page'], occurrences[40:])
+        self.assertContains(r4, "Earlier")
+        self.assertNotContains(r4, "Later")
 
     def test_ical(self):
         """
@@ -1 +1 @@
-from datetimeify import datetimeify, dayify
+from datetimeify import datetimeify, dayify, quantized_now, parse_isoformat
@@ -1,6 +1,9 @@
-from datetime import datetime, date, time
+from datetime import datetime, date, time, timedelta
+import re
 
-__all__ = ('datetimeify', 'dayify')
+from dateutil import tz
+
+__all__ = ('datetimeify', 'dayify', 'quantized_now', 'parse_isoformat')
 
 MIN = "min"
 MAX = "max"
@@ -22,4 +25,37 @@ def dayify(d): #returns two datetimes indicated the date given
         d = d.date()
     start = datetimeify(d, clamp=MIN)
     end = datetimeify(d, clamp=MAX)
-    return start, end
\ No newline at end of file
+    return start, end
+
+def quantized_now(quantum=None):
+    """
+    Returns datetime.now(), rounded down to a whole multiple of `quantum` (a timedelta) since midnight, so that the
+    queries made within the same quantum are identical. A quantum of None returns the exact time.
+    """
+    now = datetime.now()
+    if not quantum:
+        return now
+    midnight = datetime.combine(now.date(), time.min)
+    step = (quantum.days * 86400 + quantum.seconds) * 1000000 + quantum.microseconds
+    elapsed = (now - midnight).seconds * 1000000 + (now - midnight).microseconds
+    return midnight + timedelta(microseconds=elapsed - elapsed % step)
+
+_UTC_OFFSET = re.compile(r'(?:Z|([+-])(\d\d):?(\d\d))$')
+
+def parse_isoformat(s):
+    """
+    The inverse of datetime.isoformat(), which only includes microseconds if there are any, and ends with the UTC
+    offset (eg +10:00) if the datetime is aware. Unlike strftime(), it works for years before 1900.
+    """
+    tzinfo = None
+    offset = _UTC_OFFSET.search(s)
+    if offset:
+        sign, hours, minutes = offset.groups()
+        seconds = int(hours or 0) * 3600 + int(minutes or 0) * 60
+        tzinfo = tz.tzoffset(None, -seconds if sign == '-' else seconds)
+        s = s[:offset.start()]
+    if '.' in s:
+        dt = datetime.strptime(s, '%Y-%m-%dT%H:%M:%S.%f')
+    else:
+        dt = datetime.strptime(s, '%Y-%m-%dT%H:%M:%S')
+    return dt.replace(tzinfo=tzinfo)
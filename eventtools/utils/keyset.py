@@ -0,0 +1,140 @@
+"""
+Keyset (aka cursor) pagination of occurrences, in (start, end, id) order.
+
+Instead of a page number, each page links to its neighbours with an opaque token that encodes the key of the
+occurrence at its edge. The next page is then "the first n occurrences after that key", which the (start, end) indexes
+find directly, so a page costs the same however deep it is, and there is no COUNT.
+"""
+import base64
+
+from django.db.models import Q
+from django.db.models.query import QuerySet
+
+from eventtools.utils.datetimeify import parse_isoformat
+
+__all__ = ('KeysetPage', 'keyset_page')
+
+def _key(occurrence):
+    return (occurrence.start, occurrence.end, occurrence.pk or 0) #virtual occurrences have no pk
+
+def _encode(direction, key):
+    start, end, pk = key
+    raw = '%s|%s|%s|%s' % (direction, start.isoformat(), end.isoformat(), pk)
+    return base64.urlsafe_b64encode(raw).rstrip('=')
+
+def _decode(token):
+    """
+    Returns (direction, key) for a token. Raises ValueError if the token is invalid.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(str(token) + '=' * (-len(token) % 4))
+        direction, start, end, pk = raw.split('|')
+        if direction not in ('n', 'p'):
+            raise ValueError
+        return direction, (parse_isoformat(start), parse_isoformat(end), int(pk))
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError("Invalid page token: %r" % token)
+
+def _is_reversed(pool):
+    if isinstance(pool, QuerySet):
+        return not pool.query.standard_ordering
+    return getattr(pool, '_reversed', False)
+
+def _rows(pool, key, forward):
+    """
+    Returns (rows, keep): the occurrences of pool after `key` (or before it, if not `forward`) in that direction, and
+    a test the rows must pass (or None).
+
+    A QuerySet is filtered on the whole key. Other pools (eg a MergedOccurrenceQuerySet) are filtered on start, and
+    the rows that tie with the key are skipped with `keep`.
+    """
+    ascending = forward != _is_reversed(pool)
+    if isinstance(pool, QuerySet):
+        order = ('start', 'end', 'pk') if forward else ('-start', '-end', '-pk')
+        if key is None:
+            return pool.order_by(*order), None
+        start, end, pk = key
+        if ascending:
+            rows = pool.filter(Q(start__gt=start) | Q(start=start, end__gt=end) | Q(start=start, end=end, pk__gt=pk),
+                start__gte=start)
+        else:
+            rows = pool.filter(Q(start__lt=start) | Q(start=start, end__lt=end) | Q(start=start, end=end, pk__lt=pk),
+                start__lte=start)
+        return rows.order_by(*order), None
+
+    rows = pool
+    keep = None
+    if key is not None:
+        if ascending:
+            rows = rows.filter(start__gte=key[0])
+            keep = lambda o: _key(o) > key
+        else:
+            rows = rows.filter(start__lte=key[0])
+            keep = lambda o: _key(o) < key
+    if not forward:
+        rows = rows.reverse()
+    return rows, keep
+
+def _take(rows, keep, n):
+    """
+    Returns the first n rows that pass `keep`, slicing rows as little as possible.
+    """
+    if keep is None:
+        return list(rows[:n])
+    limit = n
+    while True:
+        fetched = list(rows[:limit])
+        kept = [o for o in fetched if keep(o)]
+        if len(kept) >= n or len(fetched) < limit:
+            return kept[:n]
+        limit *= 2
+
+class KeysetPage(object):
+    """
+    A page of occurrences. It has object_list, has_next, has_previous, and next_token and previous_token to pass
+    back to keyset_page (eg in a ?page= link) to get the neighbouring pages.
+    """
+    def __init__(self, object_list, previous_key=None, next_key=None):
+        self.object_list = object_list
+        self.has_previous = previous_key is not None
+        self.has_next = next_key is not None
+        self.previous_token = _encode('p', previous_key) if self.has_previous else None
+        self.next_token = _encode('n', next_key) if self.has_next else None
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_other_pages(self):
+        return self.has_previous or self.has_next
+
+def keyset_page(pool, token=None, per_page=20):
+    """
+    Returns the KeysetPage of `pool` (an occurrence queryset, in its own start order) that `token` points to, or the
+    first page if there is no token or it is invalid.
+    """
+    key = None
+    forward = True
+    if token:
+        try:
+            direction, key = _decode(token)
+            forward = direction == 'n'
+        except ValueError:
+            pass
+
+    rows, keep = _rows(pool, key, forward)
+    items = _take(rows, keep, per_page + 1)
+    more = len(items) > per_page
+    items = items[:per_page]
+    if not forward:
+        items.reverse()
+
+    if items:
+        first, last = _key(items[0]), _key(items[-1])
+    else:
+        first = last = key
+    if forward:
+        return KeysetPage(items, previous_key=key and first, next_key=more and last or None)
+    return KeysetPage(items, previous_key=more and first or None, next_key=last)
@@ -1,11 +1,11 @@
 from django.shortcuts import get_object_or_404, render_to_response
 from django.template.context import RequestContext
-from django.core.paginator import Paginator, EmptyPage, InvalidPage
 from django.utils.safestring import mark_safe
 from django.conf.urls.defaults import *
-from django.http import HttpResponse
+from django.http import HttpResponse, Http404
 from eventtools.conf import settings
 from eventtools.utils.pprint_timespan import humanized_date_range
+from eventtools.utils.keyset import keyset_page
 from dateutil.relativedelta import relativedelta
 from vobject import iCalendar
 
@@ -52,8 +52,13 @@ class EventViews(object):
 
     #occurrence
     def _occurrence_context(self, request, occurrence_id):
+        # not get_object_or_404, since occurrence_qs may be a MergedOccurrenceQuerySet
+        try:
+            occurrence = self.occurrence_qs.get(id=occurrence_id)
+        except self.occurrence_qs.model.DoesNotExist:
+            raise Http404
         return {
-            'occurrence': get_object_or_404(self.occurrence_qs, id=occurrence_id)
+            'occurrence': occurrence,
         }
     
     def occurrence(self, request, occurrence_id, ignored_part=None):
@@ -77,21 +82,8 @@ class EventViews(object):
         }
 
     def _paginate(self, request, pool):
-        paginator = Paginator(pool, settings.OCCURRENCES_PER_PAGE)
-
-        # Make sure page request is an int. If not, deliver first page.
-        try:
-            page = int(request.GET.get('page', '1'))
-        except ValueError:
-            page = 1
-
-       # If page request (9999) is out of range, deliver last page of results.
-        try:
-            pageinfo = paginator.page(page)
-        except (EmptyPage, InvalidPage):
-            pageinfo = paginator.page(paginator.num_pages)
-
-        return pageinfo
+        # ?page= is an opaque token from the previous page's links. A missing or invalid token gives the first page.
+        return keyset_page(pool, request.GET.get('page'), settings.OCCURRENCES_PER_PAGE)
     
     def event(self, request, event_slug):
         event_context = self._event_context(request, event_slug)
@@ -136,25 +128,12 @@ class EventViews(object):
                 'pageinfo': pageinfo,
                 'occurrence_pool': qs,
                 'occurrence_page': occurrence_pool,            
+                'occurrence_days': occurrence_pool.group_by_day(*date_bounds),
             }
             
         else:         
-            pageinfo = self._paginate(request, occurrence_pool)
-            
             # we're paging through all events in the pool, OCCURRENCES_PER_PAGE at a time.
-            paginator = Paginator(occurrence_pool, settings.OCCURRENCES_PER_PAGE)
-
-            # Make sure page request is an int. If not, deliver first page.
-            try:
-                page = int(request.GET.get('page', '1'))
-            except ValueError:
-                page = 1
-
-           # If page request (9999) is out of range, deliver last page of results.
-            try:
-                pageinfo = paginator.page(page)
-            except (EmptyPage, InvalidPage):
-                pageinfo = paginator.page(paginator.num_pages)
+            pageinfo = self._paginate(request, occurrence_pool)
 
             return {
                 'bounded': False,